@@ -0,0 +1,161 @@
+"""Performance benchmarks, run with airspeed velocity (asv), see asv.conf.json.
+
+    asv run                   # benchmark the latest commit, results are kept in .asv/results
+    asv continuous master HEAD  # compare two commits and report regressions
+
+All signals are synthetic and generated locally, so no downloads are needed.
+"""
+import os
+import shutil
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+from pysndfx import AudioEffectsChain
+from pysndfx.sndfiles import ENCODINGS_MAPPING
+
+RATE = 44100
+
+
+def synthetic(seconds, channels=1, dtype=np.float32):
+    """A few decaying partials and some noise, shaped like the arrays pysndfx takes."""
+    rng = np.random.RandomState(0)
+    t = np.arange(int(seconds * RATE)) / RATE
+    y = sum(np.sin(2 * np.pi * f * t) / (i + 1) for i, f in enumerate((220.0, 440.0, 1320.0)))
+    y = 0.25 * y * np.exp(-t % 1.0) + 0.01 * rng.randn(channels, len(t))
+    if dtype == np.int16:
+        y = y * 32767
+    y = y.astype(dtype)
+    return y[0] if channels == 1 else y
+
+
+def write_wav(path, snd_array):
+    y = np.atleast_2d(snd_array)
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(y.shape[0])
+        w.setsampwidth(2)
+        w.setframerate(RATE)
+        w.writeframes(np.ascontiguousarray((y.T * 32767).astype(np.int16)).tobytes())
+
+
+def effects():
+    return AudioEffectsChain().highshelf().reverb().phaser().delay().lowshelf()
+
+
+class PerCallOverhead:
+    """The fixed cost of a call: an empty chain applied to a 10 ms clip."""
+
+    def setup(self):
+        self.clip = synthetic(0.01)
+        self.chain = AudioEffectsChain()
+        self.compiled = self.chain.compile()
+
+    def time_empty_chain(self):
+        self.chain(self.clip)
+
+    def time_compiled_empty_chain(self):
+        self.compiled(self.clip)
+
+
+class Throughput:
+    """Samples processed per second for different durations, channel counts and sample types."""
+
+    params = ([1, 10, 60], [1, 2], list(ENCODINGS_MAPPING))
+    param_names = ['seconds', 'channels', 'dtype']
+    timeout = 300
+
+    def setup(self, seconds, channels, dtype):
+        self.snd_array = synthetic(seconds, channels, dtype)
+        self.chain = effects()
+
+    def time_ndarray_to_ndarray(self, seconds, channels, dtype):
+        self.chain(self.snd_array)
+
+    def track_samples_per_second(self, seconds, channels, dtype):
+        start = time.perf_counter()
+        self.chain(self.snd_array)
+        return self.snd_array.size / (time.perf_counter() - start)
+
+    track_samples_per_second.unit = 'samples/s'
+
+
+class PeakMemory:
+    """Peak RSS of processing a long stereo recording."""
+
+    params = [np.float32, np.float64]
+    param_names = ['dtype']
+    timeout = 300
+
+    def setup(self, dtype):
+        self.snd_array = np.asfortranarray(synthetic(600, 2, dtype))
+        self.chain = effects()
+
+    def peakmem_ndarray_to_ndarray(self, dtype):
+        self.chain(self.snd_array)
+
+    def peakmem_stream(self, dtype):
+        blocks = (self.snd_array[:, i:i + RATE] for i in range(0, self.snd_array.shape[1], RATE))
+        for _ in self.chain.stream(blocks, sample_in=RATE):
+            pass
+
+
+class SourcesAndDestinations:
+    """Every combination of file path, ndarray and file buffer sources and destinations."""
+
+    params = (['path', 'ndarray', 'buffer'], ['path', 'ndarray', 'buffer'])
+    param_names = ['src', 'dst']
+
+    def setup(self, src, dst):
+        self.directory = tempfile.mkdtemp()
+        self.snd_array = synthetic(10, 2)
+        self.infile = os.path.join(self.directory, 'in.wav')
+        write_wav(self.infile, self.snd_array)
+        self.outfile = os.path.join(self.directory, 'out.wav')
+        self.chain = effects()
+
+    def teardown(self, src, dst):
+        shutil.rmtree(self.directory)
+
+    def time_call(self, src, dst):
+        if src == 'path':
+            source = self.infile
+        elif src == 'ndarray':
+            source = self.snd_array
+        else:
+            source = open(self.infile, 'rb')
+        if dst == 'path':
+            destination = self.outfile
+        elif dst == 'ndarray':
+            destination = np.ndarray
+        else:
+            destination = open(self.outfile, 'wb')
+        try:
+            self.chain(source, destination)
+        finally:
+            for fp in (source, destination):
+                if hasattr(fp, 'close'):
+                    fp.close()
+
+
+class Batches:
+    """Many short clips: one process per clip, channel packing and the NumPy backend."""
+
+    params = [16, 128]
+    param_names = ['clips']
+
+    def setup(self, clips):
+        self.clips = synthetic(0.5, clips)
+        self.chain = AudioEffectsChain().highpass(40).equalizer(1000, db=3).lowshelf()
+        self.numpy_chain = AudioEffectsChain(backend='numpy').highpass(40).equalizer(1000, db=3).lowshelf()
+
+    def time_map(self, clips):
+        for _ in self.chain.map(self.clips):
+            pass
+
+    def time_apply_batch(self, clips):
+        self.chain.apply_batch(self.clips)
+
+    def time_numpy_backend(self, clips):
+        self.numpy_chain.apply_batch(self.clips)
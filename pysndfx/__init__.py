@@ -1,3 +1,6 @@
-from .dsp import AudioEffectsChain
+from .cache import ResultCache
+from .dsp import AudioEffectsChain, CompiledChain, analyze
+from .noise import NoiseProfileStore
+from .pipeline import Pipeline
 
-__all__ = ['AudioEffectsChain']
+__all__ = ['AudioEffectsChain', 'CompiledChain', 'NoiseProfileStore', 'Pipeline', 'ResultCache', 'analyze']
@@ -0,0 +1,181 @@
+"""An on-disk cache of effects chain outputs.
+
+Applying the same chain to the same audio again, for example in every epoch
+of a data augmentation pipeline, can be served from a ResultCache instead
+of running SoX:
+
+    cache = ResultCache('/tmp/pysndfx-cache', max_bytes=10 * 2 ** 30)
+    y = fx('clip.wav', cache=cache)
+
+Outputs are stored as .npy files named after a hash of the input (the bytes
+of an ndarray, or the path, size and modification time of a file), the
+chain's effects and the output parameters, and are memory-mapped read-only
+when they're served. Files are written atomically, so any number of worker
+processes can share a cache directory. The least recently used outputs are
+evicted once the directory grows beyond `max_bytes`. The total size is
+kept up to date by every put, so the directory is only scanned when it's
+over budget, and then trimmed a little further so the next puts fit.
+"""
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+from .sndfiles import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows, evictions aren't serialized between processes
+    fcntl = None
+
+# effects whose output differs from one run to the next
+RANDOM_EFFECTS = frozenset(['dither', 'synth'])
+
+
+def cacheable(effects):
+    """Check whether a chain of (name, args) effects always produces the same output."""
+    return not any(name in RANDOM_EFFECTS for name, _ in effects)
+
+
+class ResultCache(object):
+    """A directory of effects chain outputs with least recently used eviction.
+
+    `hits` and `misses` count the lookups made through this object, so with
+    several worker processes every process has its own counts.
+    """
+
+    LOW_WATER = 0.9  # of max_bytes, what eviction frees space down to
+
+    def __init__(self, directory, max_bytes=2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, chain, src, sample_in, sample_out, encoding_out, channels_out, allow_clipping):
+        """Return the cache key of a call, or None if its output can't be cached."""
+        if not cacheable(chain.effects):
+            return None
+        digest = hashlib.blake2b(digest_size=20)
+        if isinstance(src, str):
+            stat = os.stat(src)
+            digest.update(repr((os.path.abspath(src), stat.st_size, stat.st_mtime_ns)).encode())
+        elif isinstance(src, np.ndarray):
+            digest.update(repr((src.dtype.str, src.shape, sample_in)).encode())
+            digest.update(memoryview(np.ascontiguousarray(src)).cast('B'))
+        else:
+            return None  # file buffers can only be read once
+        encoding = np.dtype(encoding_out).str if encoding_out is not None else None
+        digest.update(repr((chain.backend, chain.command, sample_out, encoding, channels_out, allow_clipping)).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        """Return the cached output for `key` as a read-only memory map, or None."""
+        path = self._path(key)
+        try:
+            outsound = np.load(path, mmap_mode='r')
+            os.utime(path)  # mark it as recently used
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return outsound
+
+    def put(self, key, outsound):
+        """Store an output under `key`, then evict old outputs if over budget."""
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, outsound)
+            size = os.path.getsize(tmp)
+            with self._lock():
+                try:
+                    replaced = os.stat(self._path(key)).st_size
+                except OSError:
+                    replaced = 0
+                os.replace(tmp, self._path(key))
+                total = self._read_total()
+                if total is None:
+                    self._evict()
+                else:
+                    total += size - replaced
+                    if total > self.max_bytes:
+                        self._evict()
+                    else:
+                        self._write_total(total)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _read_total(self):
+        """The bytes of all outputs, as kept up to date by put(), or None if unknown."""
+        try:
+            with open(os.path.join(self.directory, '.bytes')) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write_total(self, total):
+        with open(os.path.join(self.directory, '.bytes'), 'w') as f:
+            f.write(str(total))
+
+    def evict(self):
+        """Remove the least recently used outputs until the cache fits in max_bytes."""
+        with self._lock():
+            self._evict()
+
+    def _evict(self):
+        # scans the whole directory, so down to LOW_WATER of the budget for the next puts to fit without one
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * self.LOW_WATER:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                logger.debug("Evicted %s from the cache" % path)
+        self._write_total(total)
+        return total
+
+    @property
+    def nbytes(self):
+        total = self._read_total()
+        if total is None:
+            with self._lock():
+                total = self._evict()
+        return total
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'bytes': self.nbytes,
+        }
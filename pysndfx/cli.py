@@ -0,0 +1,230 @@
+"""The pysndfx command, which applies an effects chain to many audio files.
+
+The chain is described in a JSON (or YAML, with PyYAML installed) file as a
+list of effects, each either a method name of AudioEffectsChain or a mapping
+from a method name to its keyword arguments (a mapping) or positional
+arguments (a list):
+
+    ["highshelf", {"reverb": {"reverberance": 40}}, {"lowpass": [3000]}]
+
+It may also be a mapping with the list under "effects" and the backend
+under "backend". Inputs are paths, glob patterns or a manifest with one path
+per line (optionally followed by a tab and the output path), and outputs
+mirror the inputs' directory tree under the output directory:
+
+    pysndfx chain.json 'corpus/**/*.flac' -o processed --format wav --workers 8
+
+Outputs are written to a temporary file and renamed when complete, and every
+finished input is appended to a journal, so an interrupted job picks up
+where it left off when it's run again. The work can be split between
+machines with --shard-index and --shard-count.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import zlib
+from multiprocessing import Pool
+
+from .dsp import AudioEffectsChain
+from .sndfiles import probe
+
+# methods of AudioEffectsChain that aren't effects
+NON_EFFECTS = frozenset([
+    'apply_async', 'apply_batch', 'apply_parallel', 'compile', 'fan_out', 'live', 'map', 'optimized', 'stream'])
+
+
+def load_chain(spec):
+    """Build an AudioEffectsChain from a parsed chain spec."""
+    if isinstance(spec, dict):
+        chain = AudioEffectsChain(backend=spec.get('backend', 'sox'))
+        effects = spec.get('effects', [])
+    else:
+        chain = AudioEffectsChain()
+        effects = spec
+    for effect in effects:
+        if isinstance(effect, str):
+            name, args = effect, {}
+        elif isinstance(effect, dict) and len(effect) == 1:
+            (name, args), = effect.items()
+        else:
+            raise ValueError("Effects must be a name or a mapping from a name to arguments, not %r." % (effect,))
+        if name.startswith('_') or name in NON_EFFECTS or not hasattr(chain, name):
+            raise ValueError("Unknown effect %r." % name)
+        method = getattr(chain, name)
+        if isinstance(args, dict):
+            method(**args)
+        elif isinstance(args, list):
+            method(*args)
+        else:
+            method(args)
+    return chain
+
+
+def read_spec(path):
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise SystemExit("Reading YAML chain specs requires PyYAML (pip install pyyaml).")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def find_inputs(patterns, manifest=None):
+    """Return (input, output or None) pairs from glob patterns and a manifest."""
+    items = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if any(c in pattern for c in '*?[') else [pattern]
+        items.extend((path, None) for path in matches if os.path.isfile(path))
+    if manifest is not None:
+        with open(manifest) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0]:
+                    items.append((fields[0], fields[1] if len(fields) > 1 and fields[1] else None))
+    return items
+
+
+def in_shard(path, index, count):
+    """Assign inputs to shards by a hash of their path, which doesn't depend on the other inputs."""
+    return zlib.crc32(path.encode()) % count == index
+
+
+def output_path(path, root, output_dir, extension=None):
+    relative = os.path.relpath(path, root)
+    if extension:
+        relative = os.path.splitext(relative)[0] + '.' + extension.lstrip('.')
+    return os.path.join(output_dir, relative)
+
+
+def read_journal(path):
+    """Return the inputs a journal says are done."""
+    done = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # a line cut short by a crash
+                    continue
+                if os.path.exists(entry['output']):
+                    done.add(entry['input'])
+    return done
+
+
+_chain = None
+
+
+def _init_worker(chain):
+    global _chain
+    _chain = chain
+
+
+def process(item):
+    """Apply the worker's chain to one input, writing the output atomically.
+
+    Returns (input, output, seconds of audio, error message or None).
+    """
+    src, dst = item
+    directory, name = os.path.split(dst)
+    os.makedirs(directory or '.', exist_ok=True)
+    stem, extension = os.path.splitext(name)
+    partial = os.path.join(directory, '.%s.%d.partial%s' % (stem, os.getpid(), extension))
+    try:
+        info = probe(src)
+        _chain(src, partial)
+        os.replace(partial, dst)
+    except Exception as e:
+        if os.path.exists(partial):
+            os.remove(partial)
+        return src, dst, 0.0, str(e).strip() or repr(e)
+    return src, dst, info.length / info.rate if info.length else 0.0, None
+
+
+class Progress(object):
+    """Prints the throughput of a job to stderr at most once per `interval` seconds."""
+
+    def __init__(self, total, interval=1.0, stream=sys.stderr):
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.done = 0
+        self.failed = 0
+        self.audio_seconds = 0.0
+        self.start = self.last = time.perf_counter()
+
+    def update(self, audio_seconds, failed):
+        self.done += 1
+        self.failed += failed
+        self.audio_seconds += audio_seconds
+        now = time.perf_counter()
+        if now - self.last >= self.interval or self.done == self.total:
+            self.last = now
+            self.stream.write('\r' + self.line())
+            self.stream.flush()
+
+    def line(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return '%d/%d files, %d failed, %.1f files/s, %.3f audio hours/s' % (
+            self.done, self.total, self.failed, self.done / elapsed, self.audio_seconds / 3600 / elapsed)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='pysndfx', description='Apply an effects chain to many audio files.')
+    parser.add_argument('chain', help='JSON or YAML file describing the effects chain')
+    parser.add_argument('inputs', nargs='*', help='input files or glob patterns (quote them, ** is recursive)')
+    parser.add_argument('-o', '--output-dir', required=True, help='directory to write the outputs to')
+    parser.add_argument('-m', '--manifest', help='file listing an input (and optionally a tab and an output) per line')
+    parser.add_argument('--root', help='directory the output tree mirrors (defaults to the inputs\' common directory)')
+    parser.add_argument('-f', '--format', help='output file extension (defaults to the input\'s)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--shard-index', type=int, default=0, help='which shard of the inputs to process')
+    parser.add_argument('--shard-count', type=int, default=1, help='how many shards the inputs are split into')
+    parser.add_argument('--journal', help='journal of finished inputs (defaults to one per shard in the output dir)')
+    args = parser.parse_args(argv)
+    if not args.inputs and args.manifest is None:
+        parser.error('no inputs given')
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error('--shard-index must be at least 0 and less than --shard-count')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    chain = load_chain(read_spec(args.chain)).compile()
+
+    items = find_inputs(args.inputs, args.manifest)
+    if not items:
+        print('Nothing to do.', file=sys.stderr)
+        return 0
+    # from all the inputs, so every shard mirrors the same tree
+    root = args.root or os.path.commonpath([os.path.dirname(os.path.abspath(src)) for src, _ in items])
+    items = [(src, dst or output_path(os.path.abspath(src), root, args.output_dir, args.format))
+             for src, dst in items if in_shard(src, args.shard_index, args.shard_count)]
+
+    journal_path = args.journal or os.path.join(
+        args.output_dir, '.pysndfx-journal-%d-of-%d' % (args.shard_index, args.shard_count))
+    done = read_journal(journal_path)
+    todo = [item for item in items if item[0] not in done]
+    print('%d inputs, %d already done.' % (len(items), len(items) - len(todo)), file=sys.stderr)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    progress = Progress(len(todo))
+    with open(journal_path, 'a') as journal, Pool(args.workers, _init_worker, (chain,)) as pool:
+        for src, dst, audio_seconds, error in pool.imap_unordered(process, todo):
+            if error is None:
+                journal.write(json.dumps({'input': src, 'output': dst, 'audio_seconds': audio_seconds}) + '\n')
+                journal.flush()
+            else:
+                print('\nFailed to process %s: %s' % (src, error), file=sys.stderr)
+            progress.update(audio_seconds, error is not None)
+    print(file=sys.stderr)
+    return 1 if progress.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,243 @@
 """A lightweight Python wrapper of SoX's effects."""
+import asyncio
+import os
 import shlex
-from io import BufferedReader, BufferedWriter
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+from itertools import chain, islice, repeat
 from subprocess import PIPE, Popen
+from threading import Thread
 
 import numpy as np
 
+from . import biquads, libsox, metrics
+from .metrics import CallRecord, LatencyReport
+from .optimizer import optimize
+from .segments import stitch, warmup
 from .sndfiles import (
     FileBufferInput,
     FileBufferOutput,
     FilePathInput,
     FilePathOutput,
+    NpyFileOutput,
     NumpyArrayInput,
     NumpyArrayOutput,
+    SoxOutput,
+    check_out,
+    interleaved_chunks,
     logger,
+    probe,
+    sample_dtype,
 )
+from .stats import parse_stats
+
+MapResult = namedtuple('MapResult', ['index', 'src', 'output', 'error'])
+
+
+class _nullcontext:
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+BACKENDS = ('sox', 'numpy', 'libsox')
+
+SOX_EFFECTS = frozenset([
+    'allpass', 'band', 'bandpass', 'bandreject', 'bass', 'bend', 'biquad', 'channels', 'chorus', 'compand',
+    'contrast', 'dcshift', 'deemph', 'delay', 'dither', 'divide', 'downsample', 'earwax', 'echo', 'echos',
+    'equalizer', 'fade', 'fir', 'firfit', 'flanger', 'gain', 'highpass', 'hilbert', 'ladspa', 'loudness',
+    'lowpass', 'mcompand', 'noiseprof', 'noisered', 'norm', 'oops', 'overdrive', 'pad', 'phaser', 'pitch',
+    'rate', 'remix', 'repeat', 'reverb', 'reverse', 'riaa', 'silence', 'sinc', 'speed', 'splice', 'stat',
+    'stats', 'stretch', 'swap', 'synth', 'tempo', 'treble', 'tremolo', 'trim', 'upsample', 'vad', 'vol',
+])
+
+
+def split_effects(tokens):
+    """Group SoX effect tokens into (name, args) pairs."""
+    effects = []
+    for token in tokens:
+        if token in SOX_EFFECTS or not effects:
+            effects.append((token, []))
+        else:
+            effects[-1][1].append(token)
+    return tuple((name, tuple(args)) for name, args in effects)
+
+
+# effects that mix channels or share state between them, so channels can't be treated as separate clips
+CHANNEL_COUPLED_EFFECTS = frozenset([
+    'channels', 'compand', 'earwax', 'flanger', 'mcompand', 'noisered', 'norm', 'oops', 'pitch', 'remix',
+    'silence', 'stretch', 'swap', 'tempo', 'vad',
+])
+
+
+def channel_independent(effects):
+    """Check whether a chain of (name, args) effects processes every channel on its own."""
+    for name, args in effects:
+        if name in CHANNEL_COUPLED_EFFECTS:
+            return False
+        if name == 'reverb':
+            params = [arg for arg in args if arg != '-w']
+            if len(params) < 4 or float(params[3]) != 0:  # stereo depth
+                return False
+        if name == 'gain' and any(arg in ('-n', '-e', '-B', '-b', '-r') for arg in args):
+            return False  # these balance or normalize all channels together
+    return True
+
+
+def _feed(pipe, chunks, record, failures=None):
+    """Write chunks of raw audio to SoX's stdin and close it.
+
+    Errors producing the chunks (e.g. reading a file object) are appended
+    to `failures`, since SoX sees a closed stdin as the end of the input
+    and would otherwise succeed with truncated audio.
+    """
+    try:
+        with record.phase('write'):
+            for chunk in chunks:
+                try:
+                    pipe.write(chunk)
+                except BrokenPipeError:
+                    break  # SoX exited early, the reason ends up on stderr
+                record.bytes_in += len(chunk)
+    except Exception as e:
+        if failures is None:
+            raise
+        failures.append(e)
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+async def _feed_async(pipe, chunks, record):
+    if chunks is None:
+        return
+    loop = asyncio.get_event_loop()
+    chunks = iter(chunks)
+    try:
+        with record.phase('write'):
+            while True:
+                # producing a chunk can block, e.g. reading a socket, or copy a lot, e.g. interleaving an array
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                try:
+                    pipe.write(chunk)
+                    await pipe.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    break  # SoX exited early, the reason ends up on stderr
+                record.bytes_in += len(chunk)
+    finally:
+        pipe.close()
+
+
+def _run_without_output(infile, effects):
+    """Run effects (tokens) over an input without writing any output, returning SoX's stderr."""
+    cmd = ['sox', '-V1'] + infile.cmd_prefix + ['-n'] + [str(token) for token in effects]
+    logger.debug("Running command : %s" % cmd)
+    chunks = infile.chunks()
+    process = Popen(cmd, stdin=PIPE if chunks is not None else None, stdout=PIPE, stderr=PIPE)
+    failures = []
+    if chunks is not None:
+        writer = Thread(target=_feed, args=(process.stdin, chunks, CallRecord('analyze'), failures), daemon=True)
+        writer.start()
+    stderr = process.stderr.read()
+    process.wait()
+    if chunks is not None:
+        writer.join()
+    process.stdout.close()
+    process.stderr.close()
+    if failures:
+        raise failures[0]
+    return stderr
+
+
+def _analyze(infile):
+    measured, stderr = parse_stats(_run_without_output(infile, ['stats']))
+    if stderr or measured is None:
+        raise RuntimeError(stderr.decode() or "SoX didn't report any stats.")
+    return measured._replace(samples=infile.length)
+
+
+@lru_cache(maxsize=4096)
+def _cached_analysis(filepath, size, mtime):
+    return _analyze(FilePathInput(filepath))
+
+
+def analyze(src, sample_in=44100):
+    """Measure the levels of a path or an ndarray in a single pass with SoX's stats effect.
+
+    Returns a stats.Stats, for example to normalize() with. Nothing is
+    written, and files are only read once: results are cached on the path,
+    size and modification time. SoX does the work in a subprocess, so
+    analyses can run on other threads while the GIL is released.
+    """
+    if isinstance(src, str):
+        stat = os.stat(src)
+        return _cached_analysis(src, stat.st_size, stat.st_mtime_ns)
+    return _analyze(NumpyArrayInput(src, sample_in))
+
+
+def _decode(filepath, encoding_out):
+    """Decode a sound file into an ndarray of `encoding_out`, returning it with its sample rate."""
+    return AudioEffectsChain()(filepath, encoding_out=encoding_out), probe(filepath).rate
+
+
+def _open(record, src, dst, sample_in, sample_out, encoding_out, channels_out, out=None, type_in=None, type_out=None):
+    """Return the SoX input and output objects (None for the default device) for a call's arguments."""
+    # depending on the input, using the right object to set up the input data arguments
+    with record.phase('probe'):
+        if isinstance(src, str):
+            infile = FilePathInput(src)
+        elif isinstance(src, np.ndarray):
+            infile = NumpyArrayInput(src, sample_in)
+        elif hasattr(src, 'read'):
+            infile = FileBufferInput(src, type_in)
+        else:
+            infile = None
+
+    npy = isinstance(dst, str) and dst.endswith('.npy')
+    if isinstance(dst, np.memmap):
+        out = dst
+    # finding out which output encoding to use in case the output is ndarray
+    if encoding_out is None and (dst is np.ndarray or out is not None or npy):
+        if out is not None:
+            encoding_out = out.dtype.type
+        elif isinstance(infile, NumpyArrayInput):
+            encoding_out = src.dtype.type
+        elif isinstance(infile, FileBufferInput):
+            encoding_out = sample_dtype(infile.info.encoding)
+        elif isinstance(infile, FilePathInput):
+            encoding_out = np.float32
+    # finding out which channel count to use (defaults to the input file's channel count)
+    if channels_out is None:
+        if infile is None:
+            channels_out = 1
+        else:
+            channels_out = infile.channels
+    if sample_out is None:  # if the output samplerate isn't specified, default to input's
+        sample_out = infile.rate if infile is not None else sample_in
+
+    # same as for the input data, but for the destination
+    if npy:
+        outfile = NpyFileOutput(dst, encoding_out, sample_out, channels_out)
+    elif isinstance(dst, str):
+        outfile = FilePathOutput(dst, sample_out, channels_out)
+    elif dst is np.ndarray or out is not None:
+        length = None
+        if infile is not None and infile.length is not None:  # a good guess, unless the effects change the length
+            length = int(np.ceil(infile.length * sample_out / infile.rate))
+        outfile = NumpyArrayOutput(encoding_out, sample_out, channels_out, out=out, length=length)
+    elif hasattr(dst, 'write'):
+        outfile = FileBufferOutput(dst, sample_out, channels_out, type_out, encoding_out)
+    else:
+        outfile = None
+    return infile, outfile
 
 
 def mutually_exclusive(*args):
@@ -21,8 +245,22 @@ def mutually_exclusive(*args):
 
 
 class AudioEffectsChain:
-    def __init__(self):
+    """A chain of SoX effects, applied by calling it.
+
+    With backend='numpy', chains made only of EQ, filters and gain (see
+    pysndfx.biquads) process ndarrays in-process without starting SoX,
+    filtering along the last axis so a whole (clips, n) batch is processed
+    at once. With backend='libsox', ndarrays are processed in-process by
+    libsox (see pysndfx.libsox) when it's installed. Any other chain, input
+    or output falls back to the sox binary.
+    """
+
+    def __init__(self, backend='sox'):
+        if backend not in BACKENDS:
+            raise ValueError("Backend has to be one of %s." % ', '.join(BACKENDS))
         self.command = []
+        self.backend = backend
+        self._compiled = None
 
     def equalizer(self, frequency, q=1.0, db=-3.0):
         """equalizer takes three parameters: filter center frequency in Hz, "q"
@@ -116,14 +354,34 @@ class AudioEffectsChain:
         self.command.append(gain)
         return self
 
-    def normalize(self):
-        """normalize has no parameters.
+    def normalize(self, level=0.0, stats=None, measure='peak'):
+        """normalize takes three parameters: target level in dB, stats and
+        what to measure ('peak' or 'rms').
+
+        It changes the level so that the loudest part of your file reaches
+        `level` dB (maximum by default), without clipping. Without `stats`,
+        SoX has to read all of the audio into a temporary file to find its
+        peak before applying any gain. With the stats of the audio reaching
+        this effect, from analyze() or a with_stats=True call, a fixed gain
+        is applied in a single pass instead, which also works for streams.
 
-        It boosts level so that the loudest part of your file reaches
-        maximum, without clipping.
+        With measure='rms' (which requires stats), the RMS level is matched
+        to `level` instead, which evens out loudness across a batch but can
+        clip.
         """
+        if stats is None:
+            if measure != 'peak':
+                raise ValueError("Normalizing the %s level needs the stats of the audio, see analyze()." % measure)
+            self.command.append('gain')
+            self.command.append('-n')
+            if level:
+                self.command.append(level)
+            return self
+        if measure not in ('peak', 'rms'):
+            raise ValueError("measure has to be 'peak' or 'rms'.")
+        measured = stats.overall.peak_db if measure == 'peak' else stats.overall.rms_db
         self.command.append('gain')
-        self.command.append('-n')
+        self.command.append(level - measured if np.isfinite(measured) else 0.0)
         return self
 
     def compand(self, attack=0.2, decay=1, soft_knee=2.0, threshold=-20, db_from=-20.0, db_to=-20.0):
@@ -226,9 +484,11 @@ class AudioEffectsChain:
         """TODO Add docstring."""
         self.command.append("bend")
         if frame_rate is not None and isinstance(frame_rate, int):
-            self.command.append('-f %s' % frame_rate)
+            self.command.append('-f')
+            self.command.append(frame_rate)
         if over_sample is not None and isinstance(over_sample, int):
-            self.command.append('-o %s' % over_sample)
+            self.command.append('-o')
+            self.command.append(over_sample)
         for bend in bends:
             self.command.append(','.join(bend))
         return self
@@ -241,7 +501,8 @@ class AudioEffectsChain:
         for decay in decays:
             modulation = decay.pop()
             numerical = decay
-            self.command.append(' '.join(map(str, numerical)) + ' -' + modulation)
+            self.command.extend(numerical)
+            self.command.append('-' + modulation)
         return self
 
     def delay(self,
@@ -288,10 +549,17 @@ class AudioEffectsChain:
         """TODO Add docstring."""
         raise NotImplementedError()
 
-    def noise_reduction(self, amount=0.5):
-        """TODO Add docstring."""
-        # TODO Run sox once with noiseprof on silent portions to generate a noise profile.
-        raise NotImplementedError()
+    def noise_reduction(self, profile, amount=0.5):
+        """noise_reduction takes two parameters: a noise profile and amount (0 to 1).
+
+        The profile is the path of a file written by SoX's noiseprof effect,
+        e.g. by NoiseProfileStore.profile(), from a recording of just the
+        noise. Higher amounts remove more noise, but also more of the signal.
+        """
+        self.command.append('noisered')
+        self.command.append(profile)
+        self.command.append(amount)
+        return self
 
     def oops(self):
         """TODO Add docstring."""
@@ -447,18 +715,22 @@ class AudioEffectsChain:
         """vol takes three parameters: gain, gain-type (amplitude, power or dB)
         and limiter gain."""
         self.command.append("vol")
+        self.command.append(gain)
         if type in ["amplitude", "power", "dB"]:
             self.command.append(type)
         else:
             raise ValueError("Type has to be dB, amplitude or power.")
         if limiter_gain is not None:
             self.command.append(str(limiter_gain))
-        print(self.command)
         return self
 
     def custom(self, command):
         """Run arbitrary SoX effect commands.
 
+        The command is split like a shell would, so arguments containing
+        spaces (like paths) must be quoted. Arguments of all other effects are
+        passed to SoX as they are.
+
         Examples:
             custom('echo 0.8 0.9 1000 0.3') for an echo effect.
 
@@ -468,81 +740,780 @@ class AudioEffectsChain:
             - http://tldp.org/LDP/LG/issue73/chung.html
             - http://dsl.org/cookbook/cookbook_29.html
         """
-        self.command.append(command)
+        self.command.extend(shlex.split(command))
         return self
 
+    def compile(self):
+        """Compile the effects chain into an immutable CompiledChain.
+
+        The effects are tokenized once and the complete SoX command line is
+        cached for every combination of input and output kinds, sample types,
+        rates and channel counts it's called with, so calling a compiled chain
+        costs little more than starting SoX. Compiled chains are hashable and
+        picklable, which makes them usable as cache keys and easy to ship to
+        worker processes. Adding effects to the chain afterwards doesn't
+        affect chains compiled earlier.
+        """
+        snapshot = tuple(self.command)
+        if self._compiled is None or self._compiled.source != snapshot or self._compiled.backend != self.backend:
+            self._compiled = CompiledChain(snapshot, self.backend)
+        return self._compiled
+
+    def optimized(self, reorder=True):
+        """Compile a cheaper equivalent of the effects chain.
+
+        Drops effects that do nothing, folds consecutive gains and merges
+        consecutive speed and upsample effects (see optimizer.optimize). The
+        changes are logged. Returns a CompiledChain.
+        """
+        effects, changes = optimize(self.compile().effects, reorder=reorder)
+        for change in changes:
+            logger.info("Optimizer %s" % change)
+        return CompiledChain([token for name, args in effects for token in (name,) + args], self.backend)
+
+    def _prepare(
+            self, record, src, dst, sample_in, sample_out, encoding_out, channels_out, allow_clipping, out=None,
+            type_in=None, type_out=None, with_stats=False):
+        infile, outfile = _open(
+            record, src, dst, sample_in, sample_out, encoding_out, channels_out, out, type_in, type_out)
+
+        chain = self.compile()
+        if with_stats:
+            chain = CompiledChain(chain.command + ('stats',), chain.backend)
+        cmd = chain.argv(infile, outfile, allow_clipping)
+        logger.debug("Running command : %s" % cmd)
+        record.argv = cmd
+        if infile is not None:
+            record.frames_in, record.rate_in = infile.length, infile.rate
+        chunks = infile.chunks() if infile is not None else None
+        return cmd, chunks, outfile if outfile is not None else SoxOutput()
+
     def __call__(
             self,
             src,
             dst=np.ndarray,
-            sample_in=44100,  # used only for arrays
+            sample_in=44100,  # used only for arrays, files carry their own rate
             sample_out=None,
             encoding_out=None,
             channels_out=None,
-            allow_clipping=True):
-
-        # depending on the input, using the right object to set up the input data arguments
-        stdin = None
-        if isinstance(src, str):
-            infile = FilePathInput(src)
-            stdin = src
-        elif isinstance(src, np.ndarray):
-            infile = NumpyArrayInput(src, sample_in)
-            stdin = src
-        elif isinstance(src, BufferedReader):
-            infile = FileBufferInput(src)
-            stdin = infile.data  # retrieving the data from the file reader (np array)
-        else:
-            infile = None
+            allow_clipping=True,
+            out=None,
+            cache=None,
+            type_in=None,
+            type_out=None,
+            with_stats=False):
+        """Apply the effects chain to `src` and write the result to `dst`.
+
+        For ndarray destinations the output can be read into `out`, a
+        preallocated writable array (see NumpyArrayOutput), which is then
+        returned trimmed to the length of the output. `dst` can also be an
+        np.memmap, which is used like `out`, or a path ending in .npy, which
+        SoX's output is streamed into and returned memory-mapped, so outputs
+        don't have to fit in memory.
+
+        `cache` is an optional ResultCache. Outputs of chains applied to paths
+        and ndarrays are stored in it, and later calls with the same input,
+        effects and parameters return them as read-only memory maps (or copy
+        them into `out`) instead of running the effects again.
+
+        `src` can also be any readable file object, which is piped to SoX as
+        it's read. Its type ('wav', 'flac', 'ogg', 'mp3'...) is sniffed from
+        its first bytes unless given as `type_in`. Likewise, `dst` can be any
+        writable file object, which SoX's output is copied to as it's encoded
+        as `type_out` (see FileBufferOutput).
+
+        With `with_stats`, SoX's stats effect measures the output in the same
+        pass, and an (output, stats.Stats) tuple is returned with the peak,
+        RMS, DC offset, number of clipped samples and so on of every
+        channel. Its `samples` is the exact number of output frames for
+        ndarray and .npy outputs, None otherwise.
+        """
+        if cache is not None and dst is np.ndarray and not with_stats:
+            key = cache.key(self.compile(), src, sample_in, sample_out, encoding_out, channels_out, allow_clipping)
+            if key is not None:
+                outsound = cache.get(key)
+                if outsound is None:
+                    outsound = self(src, dst, sample_in, sample_out, encoding_out, channels_out, allow_clipping, out)
+                    if outsound is not None:
+                        cache.put(key, outsound)
+                elif out is not None:
+                    check_out(out, outsound.dtype.type, outsound.shape[0] if outsound.ndim > 1 else 1, outsound.shape[-1])
+                    out[..., :outsound.shape[-1]] = outsound
+                    outsound = out[..., :outsound.shape[-1]]
+                return outsound
+
+        if self.backend == 'numpy' and isinstance(src, np.ndarray) and dst is np.ndarray and not with_stats:
+            outsound = self._apply_numpy(src, sample_in, sample_out, encoding_out, channels_out, out)
+            if outsound is not None:
+                return outsound
+        if self.backend == 'libsox' and isinstance(src, np.ndarray) and dst is np.ndarray and not with_stats:
+            outsound = self._apply_libsox(src, sample_in, sample_out, encoding_out, channels_out, out)
+            if outsound is not NotImplemented:
+                return outsound
+
+        record = CallRecord('call')
+        try:
+            cmd, chunks, outfile = self._prepare(
+                record, src, dst, sample_in, sample_out, encoding_out, channels_out, allow_clipping, out, type_in,
+                type_out, with_stats)
+            with record.phase('spawn'):
+                process = Popen(cmd, stdin=PIPE if chunks is not None else None, stdout=PIPE, stderr=PIPE)
+            stderr = []
+            failures = []
+            threads = [Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)]
+            if chunks is not None:
+                threads.append(Thread(target=_feed, args=(process.stdin, chunks, record, failures), daemon=True))
+            for thread in threads:
+                thread.start()
+            try:
+                with record.phase('read'):
+                    outsound = outfile.read(process.stdout)
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                with record.phase('wait'):
+                    for thread in threads:
+                        thread.join()
+                    record.user_cpu, record.system_cpu = metrics.wait(process)
+                process.stdout.close()
+                process.stderr.close()
+                record.bytes_out = outfile.nbytes
+                record.rate_out = outfile.rate
+                if outfile.frame_size:
+                    record.frames_out = outfile.nbytes // outfile.frame_size
+
+            if failures:
+                raise failures[0]
+            stderr = outfile.check(stderr[0])
+            if with_stats:
+                measured, stderr = parse_stats(stderr)
+                if measured is not None and outfile.frame_size:
+                    measured = measured._replace(samples=outfile.nbytes // outfile.frame_size)
+            if stderr:
+                raise RuntimeError(stderr.decode())
+            return (outsound, measured) if with_stats else outsound
+        except BaseException as e:
+            record.error = e
+            raise
+        finally:
+            record.finish()
+
+    def _apply_numpy(self, src, sample_in, sample_out, encoding_out, channels_out, out):
+        channels = src.shape[0] if src.ndim > 1 else 1
+        if encoding_out is None and out is not None:
+            encoding_out = out.dtype.type  # like SoX would output
+        if sample_out not in (None, sample_in) or channels_out not in (None, channels) \
+                or encoding_out not in (None, src.dtype.type) or src.dtype.type not in (np.int16, np.float32, np.float64):
+            return None
+        if out is not None:
+            check_out(out, src.dtype.type, channels)
+        if not biquads.supports(self.compile().effects):
+            logger.debug("Falling back to SoX for %s" % (self.compile(),))
+            return None
+
+        record = CallRecord('numpy')
+        record.frames_in = record.frames_out = src.shape[-1]
+        record.rate_in = record.rate_out = sample_in
+        record.bytes_in = record.bytes_out = src.nbytes
+        try:
+            with record.phase('process'):
+                outsound = biquads.apply(self.compile().effects, src, sample_in)
+            if outsound is None:
+                logger.debug("Falling back to SoX for %s" % (self.compile(),))
+            elif out is not None:
+                check_out(out, outsound.dtype.type, channels, outsound.shape[-1])
+                out[..., :outsound.shape[-1]] = outsound
+                outsound = out[..., :outsound.shape[-1]]
+            return outsound
+        except BaseException as e:
+            record.error = e
+            raise
+        finally:
+            record.finish()
+
+    def _apply_libsox(self, src, sample_in, sample_out, encoding_out, channels_out, out):
+        if not libsox.available():
+            logger.debug("libsox isn't available, falling back to SoX for %s" % (self.compile(),))
+            return NotImplemented
+        channels = src.shape[0] if src.ndim > 1 else 1
+        encoding_out = encoding_out or (out.dtype.type if out is not None else src.dtype.type)
+        if out is not None:
+            check_out(out, encoding_out, channels_out or channels)
+        record = CallRecord('libsox')
+        record.frames_in, record.rate_in = src.shape[-1], sample_in
+        record.rate_out = sample_out or sample_in
+        record.bytes_in = src.nbytes
+        try:
+            with record.phase('process'):
+                outsound = libsox.apply(
+                    self.compile().effects, src, sample_in, sample_out or sample_in, encoding_out, channels_out or channels)
+            if outsound is not None and outsound is not NotImplemented:
+                record.frames_out, record.bytes_out = outsound.shape[-1], outsound.nbytes
+                if out is not None:
+                    check_out(out, encoding_out, channels_out or channels, outsound.shape[-1])
+                    out[..., :outsound.shape[-1]] = outsound
+                    outsound = out[..., :outsound.shape[-1]]
+            return outsound
+        except BaseException as e:
+            record.error = e
+            raise
+        finally:
+            record.finish()
 
-        # finding out which output encoding to use in case the output is ndarray
-        if encoding_out is None and dst is np.ndarray:
-            if isinstance(stdin, np.ndarray):
-                encoding_out = stdin.dtype.type
-            elif isinstance(stdin, str):
-                encoding_out = np.float32
-        # finding out which channel count to use (defaults to the input file's channel count)
+    async def apply_async(
+            self,
+            src,
+            dst=np.ndarray,
+            sample_in=44100,
+            sample_out=None,
+            encoding_out=None,
+            channels_out=None,
+            allow_clipping=True,
+            out=None,
+            limiter=None,
+            type_in=None,
+            type_out=None):
+        """Apply the effects chain without blocking the event loop.
+
+        Takes the same arguments as __call__ and runs SoX through
+        asyncio.create_subprocess_exec, so many chains can be awaited
+        concurrently from a single event loop. Setting up the input (probing
+        files, serializing arrays) and reading file objects happen in the
+        loop's default executor.
+
+        `limiter` is an optional asyncio.Semaphore (or any other async context
+        manager) that bounds how many SoX processes run at once. Cancelling
+        the task kills the SoX child process.
+        """
+        loop = asyncio.get_event_loop()
+        record = CallRecord('async')
+        try:
+            cmd, chunks, outfile = await loop.run_in_executor(
+                None, self._prepare, record, src, dst, sample_in, sample_out, encoding_out, channels_out, allow_clipping,
+                out, type_in, type_out)
+
+            async with limiter if limiter is not None else _nullcontext():
+                with record.phase('spawn'):
+                    process = await asyncio.create_subprocess_exec(
+                        *cmd,
+                        stdin=PIPE if chunks is not None else None,
+                        stdout=PIPE,
+                        stderr=PIPE,
+                    )
+                try:
+                    with record.phase('read'):
+                        outsound, stderr, _ = await asyncio.gather(
+                            outfile.read_async(process.stdout),
+                            process.stderr.read(),
+                            _feed_async(process.stdin, chunks, record),
+                        )
+                    with record.phase('wait'):
+                        await process.wait()
+                except BaseException:
+                    if process.returncode is None:
+                        process.kill()
+                        await process.wait()
+                    raise
+                finally:
+                    record.bytes_out = outfile.nbytes
+                    record.rate_out = outfile.rate
+                    if outfile.frame_size:
+                        record.frames_out = outfile.nbytes // outfile.frame_size
+
+            stderr = outfile.check(stderr)
+            if stderr:
+                raise RuntimeError(stderr.decode())
+            return outsound
+        except BaseException as e:
+            record.error = e
+            raise
+        finally:
+            record.finish()
+
+    def map(self, sources, dsts=None, workers=None, ordered=True, **kwargs):
+        """Apply the effects chain to many sources concurrently.
+
+        Every source (a path, ndarray or file buffer) is processed by its own
+        SoX subprocess, driven from a pool of `workers` threads (defaults to
+        the number of CPUs). At most twice as many items as there are workers
+        are in flight at any time, so `sources` and `dsts` may be lazy
+        iterables. Remaining keyword arguments are passed on to each call.
+
+        Results are yielded as MapResult(index, src, output, error) tuples as
+        soon as they are ready, in input order if `ordered` is True and in
+        completion order otherwise. A failing item is reported through the
+        `error` field instead of aborting the whole batch.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if dsts is None:
+            dsts = repeat(np.ndarray)
+        items = enumerate(zip(sources, dsts))
+
+        def apply(index, src, dst):
+            try:
+                return MapResult(index, src, self(src, dst, **kwargs), None)
+            except Exception as e:
+                return MapResult(index, src, None, e)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque(pool.submit(apply, i, src, dst) for i, (src, dst) in islice(items, 2 * workers))
+            while pending:
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    pending = deque(future for future in pending if future not in done)
+                for future in done:
+                    yield future.result()
+                for i, (src, dst) in islice(items, len(done)):
+                    pending.append(pool.submit(apply, i, src, dst))
+
+    def stream(
+            self,
+            blocks,
+            sample_in=44100,
+            channels=None,
+            sample_out=None,
+            encoding_out=None,
+            channels_out=None,
+            block_size=8192,
+            allow_clipping=True):
+        """Apply the effects chain incrementally to an iterable of ndarray blocks.
+
+        Blocks are written to SoX's stdin from a background thread while the
+        processed audio is read back `block_size` frames at a time and yielded
+        as soon as it's available, so memory use is bounded by the block size
+        rather than by the length of the recording. All blocks must share the
+        dtype and layout of the first one: 1-D for mono and (channels, n) for
+        multichannel audio, just like the ndarrays accepted by __call__.
+        """
+        blocks = iter(blocks)
+        first = next(blocks, None)
+        if first is None:
+            return
+        infile = NumpyArrayInput(first, sample_in)
+        if channels is not None and channels != infile.channels:
+            raise ValueError("Blocks have %d channels, expected %d." % (infile.channels, channels))
+
+        if encoding_out is None:
+            encoding_out = first.dtype.type
         if channels_out is None:
-            if infile is None:
-                channels_out = 1
-            else:
-                channels_out = infile.channels
-        if sample_out is None:  # if the output samplerate isn't specified, default to input's
+            channels_out = infile.channels
+        if sample_out is None:
             sample_out = sample_in
+        outfile = NumpyArrayOutput(encoding_out, sample_out, channels_out)
 
-        # same as for the input data, but for the destination
-        if isinstance(dst, str):
-            outfile = FilePathOutput(dst, sample_out, channels_out)
-        elif dst is np.ndarray:
-            outfile = NumpyArrayOutput(encoding_out, sample_out, channels_out)
-        elif isinstance(dst, BufferedWriter):
-            outfile = FileBufferOutput(dst, sample_out, channels_out)
+        record = CallRecord('stream')
+        record.argv = cmd = self.compile().argv(infile, outfile, allow_clipping)
+        record.rate_in, record.rate_out = sample_in, sample_out
+        record.frames_in = record.frames_out = 0
+        logger.debug("Running command : %s" % cmd)
+        with record.phase('spawn'):
+            process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+
+        failures = []
+        stderr = []
+
+        def chunks():
+            for block in chain([first], blocks):
+                record.frames_in += block.shape[-1]
+                for chunk in interleaved_chunks(block):
+                    yield chunk
+
+        def feed():
+            try:
+                _feed(process.stdin, chunks(), record)
+            except Exception as e:
+                failures.append(e)
+                process.kill()
+
+        threads = [Thread(target=feed, daemon=True), Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        frame_size = outfile.frame_size
+        finished = False
+        try:
+            while True:
+                with record.phase('read'):
+                    data = process.stdout.read(block_size * frame_size)
+                if len(data) < frame_size:
+                    break
+                record.bytes_out += len(data)
+                record.frames_out += len(data) // frame_size
+                outsound = np.frombuffer(data, dtype=encoding_out, count=len(data) // frame_size * channels_out)
+                if channels_out > 1:
+                    outsound = outsound.reshape((channels_out, len(outsound) // channels_out), order='F')
+                yield outsound
+            finished = True
+        except BaseException as e:
+            record.error = e
+            raise
+        finally:
+            if not finished:  # the consumer stopped early, don't wait for the rest of the audio
+                process.kill()
+            with record.phase('wait'):
+                for thread in threads:
+                    thread.join()
+                record.user_cpu, record.system_cpu = metrics.wait(process)
+            process.stdout.close()
+            process.stderr.close()
+            if finished and (failures or stderr[0]):
+                record.error = failures[0] if failures else RuntimeError(stderr[0].decode())
+            record.finish()
+
+        if failures:
+            raise failures[0]
+        if stderr[0]:
+            raise RuntimeError(stderr[0].decode())
+
+    def live(
+            self,
+            blocks,
+            callback,
+            sample_in=44100,
+            channels=None,
+            buffer=None,
+            input_buffer=None,
+            realtime=True,
+            allow_clipping=True):
+        """Run the effects chain live and measure its input to output latency.
+
+        `blocks` stands in for an audio device: an iterable of ndarray blocks,
+        laid out like the ones taken by stream(), that are written to SoX as
+        they would be captured, i.e. paced in real time unless `realtime` is
+        False. Processed audio is passed to `callback` as soon as SoX emits
+        it. `buffer` and `input_buffer` set SoX's --buffer and --input-buffer
+        sizes in bytes: smaller buffers lower the latency, but can cause
+        underruns with expensive effects.
+
+        Latency is matched frame by frame, so the effects must not change the
+        rate or the length of the audio. Returns a metrics.LatencyReport.
+        """
+        blocks = iter(blocks)
+        first = next(blocks, None)
+        report = LatencyReport(sample_in, buffer, input_buffer)
+        if first is None:
+            return report
+        infile = NumpyArrayInput(first, sample_in)
+        if channels is not None and channels != infile.channels:
+            raise ValueError("Blocks have %d channels, expected %d." % (infile.channels, channels))
+        outfile = NumpyArrayOutput(first.dtype.type, sample_in, infile.channels)
+        frame_size = outfile.frame_size
+
+        cmd = list(self.compile().argv(infile, outfile, allow_clipping))
+        if input_buffer is not None:
+            cmd[1:1] = ['--input-buffer', str(input_buffer)]
+        if buffer is not None:
+            cmd[1:1] = ['--buffer', str(buffer)]
+        record = CallRecord('live')
+        record.argv = cmd
+        record.rate_in = record.rate_out = sample_in
+        record.frames_in = record.frames_out = 0
+        logger.debug("Running command : %s" % cmd)
+        with record.phase('spawn'):
+            process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+
+        written = deque()  # (first frame, time written) of every input block
+        failures = []
+        stderr = []
+
+        def feed():
+            start = time.perf_counter()
+            try:
+                for block in chain([first], blocks):
+                    if realtime:
+                        time.sleep(max(0.0, start + record.frames_in / sample_in - time.perf_counter()))
+                    written.append((record.frames_in, time.perf_counter()))
+                    for data in interleaved_chunks(block):
+                        process.stdin.write(data)
+                    process.stdin.flush()
+                    record.frames_in += block.shape[-1]
+                    record.bytes_in += block.nbytes
+            except BrokenPipeError:  # SoX exited, its stderr says why
+                pass
+            except Exception as e:
+                failures.append(e)
+                process.kill()
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        threads = [Thread(target=feed, daemon=True), Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        pending = bytearray()
+        read_size = max(first.shape[-1], 1) * frame_size
+        try:
+            while True:
+                data = process.stdout.read1(read_size)
+                if not data:
+                    break
+                now = time.perf_counter()
+                pending += data
+                frames = len(pending) // frame_size
+                if not frames:
+                    continue
+                outsound = np.frombuffer(bytes(pending[:frames * frame_size]), dtype=first.dtype)
+                del pending[:frames * frame_size]
+                if infile.channels > 1:
+                    outsound = outsound.reshape((infile.channels, frames), order='F')
+                report.delivered(record.frames_out, now)
+                record.frames_out += frames
+                record.bytes_out += outsound.nbytes
+                while written and written[0][0] < record.frames_out:
+                    report.latencies.append(now - written.popleft()[1])
+                callback(outsound)
+        except BaseException as e:
+            record.error = e
+            process.kill()
+            raise
+        finally:
+            with record.phase('wait'):
+                for thread in threads:
+                    thread.join()
+                record.user_cpu, record.system_cpu = metrics.wait(process)
+            process.stdout.close()
+            process.stderr.close()
+            if record.error is None and (failures or stderr[0]):
+                record.error = failures[0] if failures else RuntimeError(stderr[0].decode())
+            record.finish()
+
+        if failures:
+            raise failures[0]
+        if stderr[0]:
+            raise RuntimeError(stderr[0].decode())
+        return report
+
+    def apply_batch(
+            self,
+            batch,
+            sample_in=44100,
+            sample_out=None,
+            encoding_out=None,
+            allow_clipping=True,
+            workers=None):
+        """Apply the effects chain to a batch of clips with a single SoX process.
+
+        `batch` is a (clips, n) array of mono clips, a (clips, channels, n)
+        array, or a list of 1-D or (channels, n) clips of possibly different
+        lengths, which are zero-padded to the longest one. The clips are
+        packed into the channels of a single stream, so SoX is started once
+        per batch instead of once per clip.
+
+        This is only valid when every effect processes each channel on its
+        own. Chains with effects that mix channels or share state between
+        them (see channel_independent) fall back to processing the clips
+        separately with map() on `workers` threads.
+
+        Returns an array shaped like `batch`, or a list of arrays when `batch`
+        is a list. Padded clips are trimmed to their own length plus whatever
+        length the effects add (or remove) from the padded batch.
+        """
+        ragged = not isinstance(batch, np.ndarray)
+        clips = list(batch) if ragged else batch
+        if not len(clips):
+            return [] if ragged else batch
+        if not channel_independent(self.compile().effects):
+            logger.debug("%s mixes channels, processing the clips one by one" % (self.compile(),))
+            results = self.map(
+                clips, workers=workers, sample_in=sample_in, sample_out=sample_out, encoding_out=encoding_out,
+                allow_clipping=allow_clipping)
+            outputs = []
+            for result in results:
+                if result.error is not None:
+                    raise result.error
+                outputs.append(result.output)
+            return outputs if ragged else np.stack(outputs)
+
+        lengths = [clip.shape[-1] for clip in clips]
+        if ragged:
+            packed = np.zeros((len(clips),) + clips[0].shape[:-1] + (max(lengths),), dtype=clips[0].dtype)
+            for clip, padded in zip(clips, packed):
+                padded[..., :clip.shape[-1]] = clip
         else:
-            outfile = None
-
-        cmd = shlex.split(
-            ' '.join([
-                'sox',
-                '-N',
-                '-V1' if allow_clipping else '-V2',
-                infile.cmd_prefix if infile is not None else '-d',
-                outfile.cmd_suffix if outfile is not None else '-d',
-            ] + list(map(str, self.command))),
-            posix=False,
+            packed = clips
+        shape = packed.shape[:-1]
+
+        outsound = self(
+            packed.reshape(-1, packed.shape[-1]),
+            sample_in=sample_in,
+            sample_out=sample_out,
+            encoding_out=encoding_out,
+            allow_clipping=allow_clipping,
         )
+        if outsound.ndim == 1:  # a batch of a single mono clip
+            outsound = outsound[np.newaxis]
+        outsound = outsound.reshape(shape + outsound.shape[-1:])
+        if not ragged:
+            return outsound
 
-        logger.debug("Running command : %s" % cmd)
-        if isinstance(stdin, np.ndarray):
-            stdout, stderr = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE).communicate(stdin.tobytes(order='F'))
-        else:
-            stdout, stderr = Popen(cmd, stdout=PIPE, stderr=PIPE).communicate()
-
-        if stderr:
-            raise RuntimeError(stderr.decode())
-        elif stdout:
-            outsound = np.frombuffer(stdout, dtype=encoding_out)
-            if channels_out > 1:
-                outsound = outsound.reshape((channels_out, int(len(outsound) / channels_out)), order='F')
-            if isinstance(outfile, FileBufferOutput):
-                outfile.write(outsound)
+        ratio = (sample_out or sample_in) / sample_in
+        extra = outsound.shape[-1] - int(round(packed.shape[-1] * ratio))
+        return [clip[..., :int(round(length * ratio)) + extra] for clip, length in zip(outsound, lengths)]
+
+    def apply_parallel(
+            self,
+            src,
+            dst=np.ndarray,
+            segments=None,
+            sample_in=44100,
+            encoding_out=None,
+            channels_out=None,
+            crossfade=0.01,
+            allow_clipping=True):
+        """Apply the effects chain to a long recording in parallel segments.
+
+        The recording (a path or an ndarray) is decoded once and cut into
+        `segments` pieces (defaults to the number of CPUs) that are processed
+        by concurrent SoX processes. Each piece starts early enough for the
+        effects to reach the state a single pass would be in, e.g. the
+        longest echo delay, the time a filter takes to ring out or a
+        compander's decay (see segments.warmup). Pieces overlap by `crossfade`
+        seconds on either side of a boundary and are joined with linear
+        crossfades. The last piece keeps the tail the effects add at the end.
+
+        Effects that depend on the whole recording or on absolute time, such
+        as reverse, normalize, trim, repeat, tempo, speed, pitch or anything
+        with an LFO, raise ValueError. The output has the input's sample rate.
+        """
+        if isinstance(src, str):
+            src, sample_in = _decode(src, np.float32)
+        elif not isinstance(src, np.ndarray):
+            raise TypeError("apply_parallel needs a path or an ndarray, not %s." % type(src).__name__)
+        if encoding_out is None:
+            encoding_out = src.dtype.type
+        if segments is None:
+            segments = os.cpu_count() or 1
+
+        n = src.shape[-1]
+        fade = int(round(crossfade * sample_in))
+        warm = int(np.ceil(warmup(self.compile().effects, sample_in) * sample_in))
+        segments = max(1, min(segments, n // (2 * fade + 1)))
+        bounds = [n * k // segments for k in range(segments + 1)]
+        starts = [max(0, bound - fade) for bound in bounds[:-1]]
+        offsets = [start - max(0, start - warm) for start in starts]
+        ends = [min(n, bound + fade) for bound in bounds[1:]]
+        pieces = [src[..., start - offset:end] for start, offset, end in zip(starts, offsets, ends)]
+
+        outputs = []
+        results = self.map(
+            pieces, workers=segments, sample_in=sample_in, encoding_out=encoding_out, channels_out=channels_out,
+            allow_clipping=allow_clipping)
+        for result, start, offset, end in zip(results, starts, offsets, ends):
+            if result.error is not None:
+                raise result.error
+            last = result.index == segments - 1
+            outputs.append(result.output[..., offset:None if last else offset + end - start])
+
+        outsound = stitch(outputs, starts, fade if segments > 1 else 0)
+        if np.issubdtype(encoding_out, np.integer):
+            info = np.iinfo(encoding_out)
+            outsound = np.clip(np.round(outsound), info.min, info.max)
+        outsound = outsound.astype(encoding_out)
+        if dst is np.ndarray:
             return outsound
+        return AudioEffectsChain()(outsound, dst, sample_in=sample_in, allow_clipping=allow_clipping)
+
+    @staticmethod
+    def fan_out(src, chains, dsts=None, workers=None, sample_in=44100, **kwargs):
+        """Apply several effects chains to the same source concurrently.
+
+        A path is probed and decoded to float32 only once (see _decode), and
+        the decoded array is shared by the SoX processes of all the chains, which run on
+        a pool of `workers` threads (defaults to one per chain). This saves
+        decoding compressed files over and over when making many variants of
+        the same recording.
+
+        `dsts` optionally holds one destination per chain (defaults to
+        ndarrays) and the remaining keyword arguments are passed on to each
+        call. Returns the outputs in the order of `chains`, and raises the
+        first error after all chains have finished.
+        """
+        chains = list(chains)
+        if isinstance(src, str):
+            src, sample_in = _decode(src, np.float32)  # what calling the chains on the path would output
+        elif not isinstance(src, np.ndarray):
+            raise TypeError("fan_out needs a path or an ndarray, not %s." % type(src).__name__)
+        if dsts is None:
+            dsts = [np.ndarray] * len(chains)
+
+        def apply(chain, dst):
+            return chain(src, dst, sample_in=sample_in, **kwargs)
+
+        with ThreadPoolExecutor(max_workers=workers or len(chains) or 1) as pool:
+            futures = [pool.submit(apply, chain, dst) for chain, dst in zip(chains, dsts)]
+            wait(futures)
+        return [future.result() for future in futures]
+
+
+class CompiledChain(AudioEffectsChain):
+    """An immutable, hashable and picklable effects chain.
+
+    Created by AudioEffectsChain.compile(). It can be called, mapped,
+    streamed and awaited just like the chain it was compiled from, but
+    effects can't be added to it.
+    """
+
+    def __init__(self, command, backend='sox'):
+        tokens = tuple(str(item) for item in command)
+        object.__setattr__(self, 'command', tokens)
+        object.__setattr__(self, 'effects', split_effects(tokens))
+        object.__setattr__(self, 'backend', backend)
+        object.__setattr__(self, 'source', tuple(command))
+        object.__setattr__(self, '_argv_cache', {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledChain is immutable.")
+
+    def __eq__(self, other):
+        return isinstance(other, CompiledChain) and self.command == other.command
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.command)
+
+    def __reduce__(self):
+        return CompiledChain, (self.command, self.backend)
+
+    def __repr__(self):
+        return 'CompiledChain(%r)' % (self.command,)
+
+    def compile(self):
+        return self
+
+    def argv(self, infile, outfile, allow_clipping=True):
+        """Return the SoX command line for the given input and output."""
+        key = (
+            infile.signature if infile is not None else None,
+            outfile.signature if outfile is not None else None,
+            allow_clipping,
+        )
+        try:
+            template, slots = self._argv_cache[key]
+        except KeyError:
+            template = ['sox', '-N', '-V1' if allow_clipping else '-V2']
+            slots = []
+            for args in (infile.cmd_prefix if infile is not None else None,
+                         outfile.cmd_suffix if outfile is not None else None):
+                if args is None:
+                    template.append('-d')
+                    slots.append(None)
+                else:
+                    template.extend(args)
+                    slots.append(len(template) - 1)
+            template.extend(self.command)
+            template, slots = self._argv_cache.setdefault(key, (tuple(template), tuple(slots)))
+
+        argv = list(template)
+        for slot, io in zip(slots, (infile, outfile)):
+            if io is not None and io.filepath is not None:
+                argv[slot] = io.filepath
+        return argv
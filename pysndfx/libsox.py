@@ -0,0 +1,200 @@
+"""An in-process backend that runs effects chains with libsox through ctypes.
+
+Starting the sox binary dominates the cost of processing short clips. When
+libsox is installed, chains created with backend='libsox' build the same
+effects in-process instead: ndarrays are read from memory with
+sox_open_mem_read and written with sox_open_memstream_write. The library is
+loaded and initialized once per process, and since ctypes releases the GIL
+around foreign calls, several threads can process audio at the same time.
+Anything libsox can't be used for falls back to the sox binary. Unlike the
+sox binary, libsox doesn't dither int16 outputs.
+"""
+import atexit
+import ctypes
+import ctypes.util
+import threading
+
+import numpy as np
+
+from .sndfiles import ENCODINGS_MAPPING, logger
+
+SOX_SUCCESS = 0
+
+PRECISIONS = {
+    np.int16: 16,
+    np.float32: 24,
+    np.float64: 53,
+}
+
+
+class SignalInfo(ctypes.Structure):
+    _fields_ = [
+        ('rate', ctypes.c_double),
+        ('channels', ctypes.c_uint),
+        ('precision', ctypes.c_uint),
+        ('length', ctypes.c_uint64),
+        ('mult', ctypes.POINTER(ctypes.c_double)),
+    ]
+
+
+class EncodingInfo(ctypes.Structure):
+    _fields_ = [
+        ('encoding', ctypes.c_int),
+        ('bits_per_sample', ctypes.c_uint),
+        ('compression', ctypes.c_double),
+        ('reverse_bytes', ctypes.c_int),
+        ('reverse_nibbles', ctypes.c_int),
+        ('reverse_bits', ctypes.c_int),
+        ('opposite_endian', ctypes.c_int),
+    ]
+
+
+class Format(ctypes.Structure):
+    """The leading fields of sox_format_t, the only ones used here."""
+    _fields_ = [
+        ('filename', ctypes.c_char_p),
+        ('signal', SignalInfo),
+        ('encoding', EncodingInfo),
+    ]
+
+
+_lib = None
+_libc = None
+_lock = threading.Lock()
+
+
+def _load():
+    """Load and initialize libsox, returning None if it isn't available."""
+    global _lib, _libc
+    with _lock:
+        if _lib is None:
+            _lib = False
+            path = ctypes.util.find_library('sox')
+            if path is None:
+                logger.debug("libsox not found")
+                return None
+            try:
+                lib = ctypes.CDLL(path)
+                libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            except OSError as e:
+                logger.debug("Can't load libsox: %s" % e)
+                return None
+            format_p = ctypes.POINTER(Format)
+            lib.sox_open_mem_read.restype = format_p
+            lib.sox_open_mem_read.argtypes = [
+                ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(SignalInfo), ctypes.c_void_p, ctypes.c_char_p]
+            lib.sox_open_memstream_write.restype = format_p
+            lib.sox_open_memstream_write.argtypes = [
+                ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_size_t), ctypes.POINTER(SignalInfo),
+                ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p]
+            lib.sox_close.argtypes = [format_p]
+            lib.sox_create_effects_chain.restype = ctypes.c_void_p
+            lib.sox_create_effects_chain.argtypes = [ctypes.POINTER(EncodingInfo), ctypes.POINTER(EncodingInfo)]
+            lib.sox_delete_effects_chain.argtypes = [ctypes.c_void_p]
+            lib.sox_find_effect.restype = ctypes.c_void_p
+            lib.sox_find_effect.argtypes = [ctypes.c_char_p]
+            lib.sox_create_effect.restype = ctypes.c_void_p
+            lib.sox_create_effect.argtypes = [ctypes.c_void_p]
+            lib.sox_effect_options.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
+            lib.sox_add_effect.argtypes = [
+                ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(SignalInfo), ctypes.POINTER(SignalInfo)]
+            lib.sox_flow_effects.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+            libc.free.argtypes = [ctypes.c_void_p]
+            if lib.sox_init() != SOX_SUCCESS:
+                logger.debug("sox_init failed")
+                return None
+            atexit.register(lib.sox_quit)
+            _lib, _libc = lib, libc
+    return _lib or None
+
+
+def available():
+    return _load() is not None
+
+
+def _add_effect(chain, name, args, signal, out_signal, pointer=None):
+    """Add an effect to a libsox chain, `pointer` is the argument of the input and output effects."""
+    handler = _lib.sox_find_effect(name.encode())
+    if not handler:
+        raise RuntimeError("libsox doesn't know the %s effect." % name)
+    effect = _lib.sox_create_effect(handler)
+    try:
+        if pointer is not None:
+            strings = []
+            argv = (ctypes.c_void_p * 1)(ctypes.cast(pointer, ctypes.c_void_p))
+            argc = 1
+        else:
+            strings = [ctypes.create_string_buffer(str(arg).encode()) for arg in args]
+            argv = (ctypes.c_void_p * max(len(strings), 1))(*[ctypes.addressof(string) for string in strings])
+            argc = len(strings)
+        if _lib.sox_effect_options(effect, argc, argv) != SOX_SUCCESS:
+            raise RuntimeError("Invalid arguments for %s: %s" % (name, ' '.join(str(arg) for arg in args)))
+        if _lib.sox_add_effect(chain, effect, ctypes.byref(signal), ctypes.byref(out_signal)) != SOX_SUCCESS:
+            raise RuntimeError("libsox can't add the %s effect." % name)
+    finally:
+        _libc.free(effect)
+
+
+def apply(effects, snd_array, rate, sample_out, encoding_out, channels_out):
+    """Run a chain of (name, args) effects over a 1-D or (channels, n) array with libsox.
+
+    Returns the output array (None if it's empty), or raises RuntimeError
+    if libsox rejects the chain. Returns NotImplemented if libsox isn't
+    available or can't read the array, so the caller can fall back to SoX.
+    """
+    lib = _load()
+    if lib is None or snd_array.dtype.type not in ENCODINGS_MAPPING or encoding_out not in ENCODINGS_MAPPING:
+        return NotImplemented
+    channels = snd_array.shape[0] if snd_array.ndim > 1 else 1
+    frames = np.ascontiguousarray(snd_array.T)  # interleaved
+
+    in_signal = SignalInfo(rate, channels, PRECISIONS[snd_array.dtype.type], frames.size, None)
+    out_signal = SignalInfo(sample_out, channels_out, PRECISIONS[encoding_out], 0, None)
+    buffer = ctypes.c_void_p()
+    size = ctypes.c_size_t()
+
+    infile = lib.sox_open_mem_read(
+        frames.ctypes.data, frames.nbytes, ctypes.byref(in_signal), None, ENCODINGS_MAPPING[snd_array.dtype.type].encode())
+    if not infile:
+        raise RuntimeError("libsox can't read the input array.")
+    outfile = None
+    chain = None
+    try:
+        outfile = lib.sox_open_memstream_write(
+            ctypes.byref(buffer), ctypes.byref(size), ctypes.byref(out_signal), None,
+            ENCODINGS_MAPPING[encoding_out].encode(), None)
+        if not outfile:
+            raise RuntimeError("libsox can't open the output stream.")
+        chain = lib.sox_create_effects_chain(
+            ctypes.byref(infile.contents.encoding), ctypes.byref(outfile.contents.encoding))
+
+        signal = SignalInfo.from_buffer_copy(infile.contents.signal)
+        _add_effect(chain, 'input', [], signal, infile.contents.signal, pointer=infile)
+        for name, args in effects:
+            _add_effect(chain, name, args, signal, outfile.contents.signal)
+        if signal.rate != outfile.contents.signal.rate:
+            _add_effect(chain, 'rate', [], signal, outfile.contents.signal)
+        if signal.channels != outfile.contents.signal.channels:
+            _add_effect(chain, 'channels', [], signal, outfile.contents.signal)
+        _add_effect(chain, 'output', [], signal, outfile.contents.signal, pointer=outfile)
+
+        if lib.sox_flow_effects(chain, None, None) != SOX_SUCCESS:
+            raise RuntimeError("libsox failed to apply %s" % ' '.join(name for name, _ in effects))
+    finally:
+        if chain:
+            lib.sox_delete_effects_chain(chain)
+        if outfile:
+            lib.sox_close(outfile)  # flushes the memstream into buffer and size
+        lib.sox_close(infile)
+
+    try:
+        if not size.value:
+            return None
+        data = ctypes.string_at(buffer, size.value)
+    finally:
+        if buffer:
+            _libc.free(buffer)
+    outsound = np.frombuffer(data, dtype=encoding_out)
+    if channels_out > 1:
+        outsound = outsound.reshape((channels_out, len(outsound) // channels_out), order='F')
+    return outsound
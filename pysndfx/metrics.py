@@ -0,0 +1,185 @@
+"""Instrumentation of effects chain invocations.
+
+Every run of an effects chain, whether it's a plain call, a batch, a stream
+or an asyncio call, produces a CallRecord that is passed to the hooks
+registered with add_hook(), for example to export it to a metrics system:
+
+    from pysndfx import metrics
+    metrics.add_hook(lambda record: print(record.as_dict()))
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger('pysndfx')
+
+_hooks = []
+
+
+def add_hook(hook):
+    """Call `hook` with the CallRecord of every invocation from now on."""
+    _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def wait(process):
+    """Reap a SoX process and return its (user, system) CPU time in seconds.
+
+    The CPU time is (None, None) where os.wait4 isn't available.
+    """
+    if hasattr(os, 'wait4') and process.returncode is None:
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+        except ChildProcessError:  # already reaped by Popen
+            pass
+        else:
+            process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            return rusage.ru_utime, rusage.ru_stime
+    process.wait()
+    return None, None
+
+
+class CallRecord(object):
+    """Timings, CPU time and I/O of a single invocation of an effects chain.
+
+    `kind` is the API that made the call ('call', 'async', 'stream', 'live',
+    'pipeline', 'numpy' or 'libsox'), and `phases` maps phase names (probe, spawn, write, read,
+    wait, process) to wall-clock seconds. Writing to SoX and reading from it
+    happen concurrently, so phases can overlap. Failed calls are recorded
+    too, with the exception in `error`.
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.argv = None
+        self.phases = {}
+        self.wall = None
+        self.user_cpu = None
+        self.system_cpu = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = None
+        self.frames_out = None
+        self.rate_in = None
+        self.rate_out = None
+        self.error = None
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    @property
+    def audio_seconds(self):
+        if self.frames_in is not None and self.rate_in:
+            return self.frames_in / self.rate_in
+        if self.frames_out is not None and self.rate_out:
+            return self.frames_out / self.rate_out
+        return None
+
+    @property
+    def realtime_factor(self):
+        """Seconds of audio processed per second of wall time."""
+        if self.audio_seconds is None or not self.wall:
+            return None
+        return self.audio_seconds / self.wall
+
+    def as_dict(self):
+        return {
+            'kind': self.kind,
+            'argv': self.argv,
+            'phases': dict(self.phases),
+            'wall': self.wall,
+            'user_cpu': self.user_cpu,
+            'system_cpu': self.system_cpu,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'audio_seconds': self.audio_seconds,
+            'realtime_factor': self.realtime_factor,
+            'error': repr(self.error) if self.error is not None else None,
+        }
+
+    def finish(self):
+        """Stop the clock and hand the record to the registered hooks."""
+        self.wall = time.perf_counter() - self._start
+        for hook in list(_hooks):
+            try:
+                hook(self)
+            except Exception:
+                logger.exception("Metrics hook %r failed" % (hook,))
+
+
+class LatencyReport(object):
+    """Input to output latency of a live run of an effects chain.
+
+    `latencies` holds the seconds between writing each input block to SoX and
+    reading back the processed audio of its first frame. An underrun is
+    counted whenever processed audio arrives later than a playback device
+    that started with the first processed block would have needed it.
+    """
+
+    def __init__(self, rate, buffer=None, input_buffer=None):
+        self.rate = rate
+        self.buffer = buffer
+        self.input_buffer = input_buffer
+        self.latencies = []
+        self.underruns = 0
+        self._playback_start = None
+
+    def delivered(self, start_frame, now):
+        """Note that processed audio from `start_frame` on was read at `now`."""
+        due = self._playback_start + start_frame / self.rate if self._playback_start is not None else None
+        if due is not None and now > due:
+            self.underruns += 1
+        if due is None or now > due:  # playback (re)starts with this block
+            self._playback_start = now - start_frame / self.rate
+
+    def _percentile(self, q):
+        return float(np.percentile(self.latencies, q)) if self.latencies else None
+
+    @property
+    def mean(self):
+        return float(np.mean(self.latencies)) if self.latencies else None
+
+    @property
+    def p50(self):
+        return self._percentile(50)
+
+    @property
+    def p95(self):
+        return self._percentile(95)
+
+    @property
+    def max(self):
+        return max(self.latencies) if self.latencies else None
+
+    @property
+    def jitter(self):
+        """Standard deviation of the latency."""
+        return float(np.std(self.latencies)) if self.latencies else None
+
+    def as_dict(self):
+        return {
+            'buffer': self.buffer,
+            'input_buffer': self.input_buffer,
+            'blocks': len(self.latencies),
+            'mean': self.mean,
+            'p50': self.p50,
+            'p95': self.p95,
+            'max': self.max,
+            'jitter': self.jitter,
+            'underruns': self.underruns,
+        }
@@ -0,0 +1,86 @@
+"""Noise profiles for noise_reduction, computed once and reused.
+
+SoX's noisered effect needs a profile of the noise, written by the
+noiseprof effect in a separate pass over a recording of just the noise.
+Recordings made on the same setup share their noise, so a NoiseProfileStore
+computes a profile once per key (a device, session or anything else naming
+the setup) and keeps it in memory and on disk:
+
+    store = NoiseProfileStore('~/.cache/noise-profiles')
+    profile = store.profile('studio-a', src='room-tone.wav')
+    fx = AudioEffectsChain().noise_reduction(profile, amount=0.3)
+
+Profile files are written atomically, so worker processes can share a
+directory.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+import numpy as np
+
+from .dsp import _run_without_output
+from .sndfiles import FilePathInput, NumpyArrayInput
+
+
+class NoiseProfileStore(object):
+    """Noise profiles by key, kept in `directory` (a temporary one by default)."""
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='pysndfx-noise-')
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        """The file a key's profile is stored in."""
+        readable = re.sub(r'[^A-Za-z0-9_.-]+', '_', str(key))[:64]
+        digest = hashlib.sha1(str(key).encode()).hexdigest()[:12]
+        return os.path.join(self.directory, '%s-%s.prof' % (readable, digest))
+
+    def get(self, key):
+        """Return the path of a stored profile, or None."""
+        with self._lock:
+            if key in self._profiles:
+                return self._profiles[key]
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with self._lock:
+            self._profiles[key] = path
+        return path
+
+    def profile(self, key, src=None, sample_in=44100, start=None, end=None):
+        """Return the path of a key's profile, computing it from `src` if it isn't stored yet.
+
+        `src` is a path or ndarray of just the noise, or of a recording whose
+        noise-only part lies between `start` and `end` seconds.
+        """
+        path = self.get(key)
+        if path is not None:
+            return path
+        if src is None:
+            raise KeyError("No noise profile for %r, please give a recording of the noise." % (key,))
+
+        infile = FilePathInput(src) if isinstance(src, str) else NumpyArrayInput(np.asarray(src), sample_in)
+        effects = []
+        if start is not None or end is not None:
+            effects += ['trim', start or 0] + (['=%s' % end] if end is not None else [])
+        path = self.path(key)
+        fd, partial = tempfile.mkstemp(suffix='.prof', dir=self.directory)
+        os.close(fd)
+        try:
+            stderr = _run_without_output(infile, effects + ['noiseprof', partial])
+            if stderr:
+                raise RuntimeError(stderr.decode())
+            os.replace(partial, path)
+        except BaseException:
+            os.remove(partial)
+            raise
+        with self._lock:
+            self._profiles[key] = path
+        return path
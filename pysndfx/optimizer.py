@@ -0,0 +1,143 @@
+"""Rewriting effects chains into cheaper equivalent ones.
+
+Every effect in a chain is a full pass over every sample in SoX, so chains
+built programmatically often waste time on effects that do nothing or that
+could be combined. optimize() rewrites a chain of (name, args) effects:
+
+- effects that do nothing (0 dB gain, unity vol, 0 dB equalizer, bass and
+  treble, speed 1, upsample 1) are dropped,
+- consecutive gain and vol effects are folded into a single vol,
+- attenuations are moved forward through filters to be folded with an
+  earlier gain or vol,
+- consecutive speed and upsample effects are merged.
+
+SoX clips after every effect, so gains are only folded where no intermediate
+result could clip differently: when every partial product is an
+attenuation, or when every factor is an amplification. Moving an
+attenuation before a filter only changes the output when the filter clipped
+in the original chain. Folded values are rounded to 10 significant digits.
+
+Cascaded filters are left alone: two biquads can't be merged into one.
+"""
+from .biquads import UnsupportedEffect, design
+
+LINEAR_EFFECTS = frozenset([
+    'allpass', 'band', 'bandpass', 'bandreject', 'bass', 'biquad', 'equalizer', 'highpass', 'lowpass', 'treble'])
+
+
+def _format(number):
+    return '%.10g' % number
+
+
+def _scalar(name, args):
+    """Return the linear gain of a plain gain or vol effect, or None."""
+    if name not in ('gain', 'vol'):
+        return None
+    try:
+        return design(name, args, None)
+    except (UnsupportedEffect, ValueError, IndexError):
+        return None
+
+
+def _speed(args):
+    if len(args) != 1:
+        return None
+    factor = str(args[0])
+    try:
+        if factor.endswith('c'):
+            return 2 ** (float(factor[:-1]) / 1200)
+        return float(factor)
+    except ValueError:
+        return None
+
+
+def _is_noop(name, args):
+    if name in ('gain', 'vol'):
+        return _scalar(name, args) == 1
+    if name in ('equalizer', 'bass', 'treble'):
+        params = [arg for arg in args if arg not in ('-1', '-2', '-c')]
+        position = 2 if name == 'equalizer' else 0  # equalizer frequency width gain, bass/treble gain [frequency]
+        try:
+            return float(params[position]) == 0
+        except (ValueError, IndexError):
+            return False
+    if name == 'speed':
+        return _speed(args) == 1
+    if name == 'upsample':
+        return tuple(args) in (('1',), ())
+    return False
+
+
+def _foldable(factors):
+    products = [1.0]
+    for factor in factors:
+        products.append(products[-1] * factor)
+    return all(abs(p) <= 1 for p in products) or all(abs(f) >= 1 for f in factors)
+
+
+def optimize(effects, reorder=True):
+    """Rewrite a chain of (name, args) effects into a cheaper equivalent one.
+
+    Returns the new effects and a list of human-readable descriptions of
+    what was changed. Attenuations are only moved through filters if
+    `reorder` is True.
+    """
+    effects = [(name, tuple(str(arg) for arg in args)) for name, args in effects]
+    changes = []
+
+    def drop_noops():
+        for name, args in list(effects):
+            if _is_noop(name, args):
+                effects.remove((name, args))
+                changes.append('dropped %s' % ' '.join((name,) + args))
+
+    drop_noops()
+
+    if reorder:
+        for i in range(len(effects)):
+            factor = _scalar(*effects[i])
+            if factor is None or abs(factor) > 1:
+                continue
+            j = i
+            while j > 0 and effects[j - 1][0] in LINEAR_EFFECTS:
+                j -= 1
+            if j < i and j > 0 and _scalar(*effects[j - 1]) is not None:
+                effect = effects.pop(i)
+                effects.insert(j, effect)
+                changes.append('moved %s before %s' % (' '.join((effect[0],) + effect[1]), effects[j + 1][0]))
+
+    i = 0
+    while i < len(effects):
+        name, args = effects[i]
+        run = i + 1
+        if _scalar(name, args) is not None:
+            while run < len(effects) and _scalar(*effects[run]) is not None:
+                run += 1
+            factors = [_scalar(*effect) for effect in effects[i:run]]
+            if run - i > 1 and _foldable(factors):
+                product = 1.0
+                for factor in factors:
+                    product *= factor
+                folded = ('vol', (_format(product),))
+                changes.append('folded %s into %s' % (
+                    ', '.join(' '.join((n,) + a) for n, a in effects[i:run]), ' '.join((folded[0],) + folded[1])))
+                effects[i:run] = [folded]
+        elif name in ('speed', 'upsample'):
+            while run < len(effects) and effects[run][0] == name:
+                run += 1
+            if run - i > 1:
+                if name == 'speed':
+                    factors = [_speed(args) for _, args in effects[i:run]]
+                else:
+                    factors = [float(args[0]) if args else 1.0 for _, args in effects[i:run]]
+                if None not in factors:
+                    product = 1.0
+                    for factor in factors:
+                        product *= factor
+                    merged = (name, (_format(product),))
+                    changes.append('merged %d %s effects into %s %s' % (run - i, name, name, merged[1][0]))
+                    effects[i:run] = [merged]
+        i += 1
+
+    drop_noops()
+    return tuple(effects), changes
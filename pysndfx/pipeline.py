@@ -0,0 +1,225 @@
+"""Pipelines of effects chains and NumPy processing that run concurrently.
+
+Calling a chain, processing its output with NumPy and calling another chain
+materializes the whole recording at every step. A Pipeline connects the
+steps instead:
+
+    pipeline = Pipeline(
+        AudioEffectsChain().highpass(80),
+        lambda block: np.tanh(3 * block),
+        AudioEffectsChain().reverb(),
+    )
+    y = pipeline('speech.wav')
+
+Adjacent effects chains are connected with OS pipes, so the audio between
+them never passes through Python. Any other stage is a callable that is
+given blocks of float32 samples (1-D for mono, (channels, n) otherwise) on
+a thread of its own, and returns the processed block. All stages run at
+the same time with only a pipe's worth of audio between them, so memory
+use doesn't grow with the length of the recording.
+"""
+import os
+from subprocess import PIPE, Popen
+from threading import Thread
+
+import numpy as np
+
+from . import metrics
+from .dsp import AudioEffectsChain, CompiledChain, _feed, _open
+from .metrics import CallRecord
+from .sndfiles import (
+    RawPipeInput,
+    RawPipeOutput,
+    SoxOutput,
+    interleaved_chunks,
+    logger,
+)
+
+# the samples passed between stages
+ENCODING = np.float32
+
+
+def _run_blocks(function, reader, writer, channels, block_size, failures, abort):
+    """Apply a block-wise callable to raw audio from `reader`, writing the results to `writer`."""
+    frame_size = np.dtype(ENCODING).itemsize * channels
+    try:
+        while True:
+            data = bytearray(block_size * frame_size)
+            frames = (reader.readinto(data) or 0) // frame_size
+            if not frames:
+                break
+            block = np.frombuffer(data, dtype=ENCODING, count=frames * channels)
+            if channels > 1:
+                block = block.reshape((channels, frames), order='F')
+            result = function(block)
+            if result is None:
+                continue
+            result = np.asarray(result, dtype=ENCODING)
+            if (result.ndim != 1 if channels == 1 else result.ndim != 2 or result.shape[0] != channels):
+                raise ValueError("%r returned a block of shape %s, expected %s." % (
+                    function, result.shape, '(n,)' if channels == 1 else '(%d, n)' % channels))
+            for chunk in interleaved_chunks(result):
+                writer.write(chunk)
+    except BrokenPipeError:
+        pass  # a later stage exited early, the reason ends up on its stderr
+    except Exception as e:
+        failures.append(e)
+        abort()
+    finally:
+        for f in (writer, reader):
+            try:
+                f.close()
+            except BrokenPipeError:
+                pass
+
+
+class Pipeline(object):
+    """Effects chains and block-wise callables applied one after the other.
+
+    Audio passes between stages as float32 at the rate and channel count of
+    the input (SoX converts back to them after effects that change them),
+    `block_size` frames at a time for callables, which must return blocks
+    with the same number of channels. Only the output of the last stage is
+    converted as requested with `sample_out`, `encoding_out` and
+    `channels_out`, and it's written to `dst` like AudioEffectsChain does.
+    """
+
+    def __init__(self, *stages, block_size=8192):
+        self.stages = []
+        for stage in stages:
+            if isinstance(stage, AudioEffectsChain):
+                stage = stage.compile()
+            elif not callable(stage):
+                raise TypeError("Stages must be effects chains or callables, not %r." % (stage,))
+            self.stages.append(stage)
+        # SoX decodes the input and encodes the output
+        if not self.stages or not isinstance(self.stages[0], CompiledChain):
+            self.stages.insert(0, CompiledChain(()))
+        if not isinstance(self.stages[-1], CompiledChain):
+            self.stages.append(CompiledChain(()))
+        self.block_size = block_size
+
+    def __repr__(self):
+        return 'Pipeline(%s)' % ', '.join(repr(stage) for stage in self.stages)
+
+    def __call__(
+            self,
+            src,
+            dst=np.ndarray,
+            sample_in=44100,  # used only for arrays, files carry their own rate
+            sample_out=None,
+            encoding_out=None,
+            channels_out=None,
+            allow_clipping=True,
+            out=None,
+            type_in=None,
+            type_out=None):
+        """Run the pipeline over `src` and write the result to `dst`, see AudioEffectsChain.__call__."""
+        record = CallRecord('pipeline')
+        processes = []
+        threads = []
+        stderrs = []
+        failures = []
+        outfile = None
+
+        def abort():
+            for process in processes:
+                process.kill()
+
+        def drain(process):
+            index = len(stderrs)
+            stderrs.append(b'')
+
+            def read():
+                stderrs[index] = process.stderr.read()
+            threads.append(Thread(target=read, daemon=True))
+
+        try:
+            infile, outfile = _open(
+                record, src, dst, sample_in, sample_out, encoding_out, channels_out, out, type_in, type_out)
+            if infile is None:
+                raise ValueError("Pipelines need an input.")
+            if outfile is None:
+                outfile = SoxOutput()
+            raw_in = RawPipeInput(ENCODING, infile.rate, infile.channels)
+            raw_out = RawPipeOutput(ENCODING, infile.rate, infile.channels)
+            record.frames_in, record.rate_in = infile.length, infile.rate
+            record.argv = []
+
+            upstream = None  # the read end of the previous stage's output
+            pending = None  # a callable waiting for the stage after it to be set up
+            last = len(self.stages) - 1
+            with record.phase('spawn'):
+                for index, stage in enumerate(self.stages):
+                    if record.argv:
+                        record.argv.append('|')
+                    if not isinstance(stage, CompiledChain):
+                        record.argv.append(getattr(stage, '__name__', repr(stage)))
+                        if pending is not None:
+                            read_fd, write_fd = os.pipe()
+                            writer = os.fdopen(write_fd, 'wb')
+                            threads.append(Thread(target=_run_blocks, args=(
+                                pending[0], pending[1], writer, infile.channels, self.block_size, failures, abort),
+                                daemon=True))
+                            upstream = os.fdopen(read_fd, 'rb')
+                        pending = (stage, upstream)
+                        continue
+
+                    cmd = stage.argv(infile if index == 0 else raw_in, outfile if index == last else raw_out,
+                                     allow_clipping)
+                    logger.debug("Running command : %s" % cmd)
+                    record.argv.extend(cmd)
+                    chunks = infile.chunks() if index == 0 else None
+                    if index == 0:
+                        stdin = PIPE if chunks is not None else None
+                    else:
+                        stdin = upstream if pending is None else PIPE
+                    process = Popen(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE)
+                    processes.append(process)
+                    drain(process)
+                    if chunks is not None:
+                        threads.append(Thread(target=_feed, args=(process.stdin, chunks, record, failures), daemon=True))
+                    if pending is not None:
+                        threads.append(Thread(target=_run_blocks, args=(
+                            pending[0], pending[1], process.stdin, infile.channels, self.block_size, failures, abort),
+                            daemon=True))
+                        pending = None
+                    elif upstream is not None:
+                        upstream.close()  # the processes have it now, so SoX sees it closed when one of them exits
+                    upstream = process.stdout
+            for thread in threads:
+                thread.start()
+
+            with record.phase('read'):
+                outsound = outfile.read(processes[-1].stdout)
+        except BaseException as e:
+            abort()
+            record.error = e
+            raise
+        finally:
+            with record.phase('wait'):
+                for thread in threads:
+                    if thread.ident is not None:
+                        thread.join()
+                for process in processes:
+                    user_cpu, system_cpu = metrics.wait(process)
+                    if user_cpu is not None:
+                        record.user_cpu = (record.user_cpu or 0.0) + user_cpu
+                        record.system_cpu = (record.system_cpu or 0.0) + system_cpu
+                    process.stdout.close()
+                    process.stderr.close()
+            record.bytes_out = outfile.nbytes if outfile is not None else 0
+            record.rate_out = outfile.rate if outfile is not None else None
+            if outfile is not None and outfile.frame_size:
+                record.frames_out = outfile.nbytes // outfile.frame_size
+            if record.error is not None:
+                record.finish()
+
+        stderrs[-1] = outfile.check(stderrs[-1])
+        error = failures[0] if failures else next(
+            (RuntimeError(stderr.decode()) for stderr in stderrs if stderr), None)
+        record.error = error
+        record.finish()
+        if error is not None:
+            raise error
+        return outsound
@@ -0,0 +1,89 @@
+"""Splitting long recordings into segments that can be processed independently.
+
+A segment can only be processed on its own if every effect is time-invariant
+and forgets its input after a while, so that running it over some audio from
+before the segment (the warm-up) recreates the state a single pass would be
+in. The warm-up is chosen so that the state left over from before it has
+decayed below TAIL_LEVEL, which bounds the difference to a single pass.
+Overlapping segments are then joined with linear crossfades.
+"""
+import numpy as np
+
+from .biquads import SUPPORTED_EFFECTS as BIQUAD_EFFECTS
+from .biquads import UnsupportedEffect, design
+
+TAIL_LEVEL = 1e-5  # about -100 dB
+
+MEMORYLESS_EFFECTS = frozenset(['dcshift', 'vol'])
+
+
+def _poles_decay(biquad, rate):
+    """Seconds until a biquad's impulse response has decayed below TAIL_LEVEL."""
+    b0, b1, b2, a0, a1, a2 = biquad
+    radius = np.abs(np.roots([a0, a1, a2])).max() if a2 or a1 else 0.0
+    if radius <= 0:
+        return 2.0 / rate
+    if radius >= 1:
+        raise ValueError("Unstable filter %s can't be segmented." % (biquad,))
+    return np.log(TAIL_LEVEL) / np.log(radius) / rate
+
+
+def _numbers(args):
+    return [float(arg) for arg in args if not arg.startswith('-') or arg.lstrip('-').replace('.', '', 1).isdigit()]
+
+
+def warmup(effects, rate):
+    """Return how many seconds of preceding audio a chain of (name, args) effects needs.
+
+    Raises ValueError for effects that aren't time-invariant or that depend on
+    the whole recording, such as reverse, normalization, trim, repeat, tempo
+    or anything modulated by an LFO.
+    """
+    seconds = 0.0
+    for name, args in effects:
+        if name in MEMORYLESS_EFFECTS:
+            continue
+        if name == 'gain':
+            if any(arg.startswith('-') and arg != '-l' and not arg.lstrip('-').replace('.', '', 1).isdigit()
+                   for arg in args):
+                raise ValueError("gain %s depends on the whole recording." % ' '.join(args))
+        elif name in BIQUAD_EFFECTS:
+            try:
+                seconds += _poles_decay(design(name, args, rate), rate)
+            except (UnsupportedEffect, IndexError) as e:
+                raise ValueError("Can't estimate how long %s %s rings: %s" % (name, ' '.join(args), e))
+        elif name in ('echo', 'echos'):
+            delays = _numbers(args)[2::2]  # gain-in, gain-out, then delay/decay pairs in ms
+            seconds += (sum(delays) if name == 'echos' else max(delays)) / 1000
+        elif name == 'reverb':
+            numbers = _numbers(args)
+            reverberance, room_scale = numbers[0] if numbers else 50, numbers[2] if len(numbers) > 2 else 100
+            pre_delay = numbers[4] if len(numbers) > 4 else 0
+            # generous: at full reverberance and room scale SoX's reverb takes a few seconds to fade out
+            seconds += pre_delay / 1000 + 1 + 5 * reverberance / 100 * room_scale / 100
+        elif name == 'compand':
+            times = [float(t) for t in args[0].split(',')]
+            seconds += -np.log(TAIL_LEVEL) * max(times)
+        elif name == 'overdrive':
+            seconds += 0.01
+        else:
+            raise ValueError("%s isn't time-invariant, so it can't be applied segment by segment." % name)
+    return seconds
+
+
+def stitch(pieces, starts, fade):
+    """Join overlapping pieces of audio with linear crossfades.
+
+    Piece k starts at frame `starts[k]` and overlaps the end of piece k - 1 by
+    2 * fade frames. The last piece may run past the others (effect tails).
+    """
+    length = starts[-1] + pieces[-1].shape[-1]
+    stitched = np.zeros(pieces[0].shape[:-1] + (length,))
+    for k, (piece, start) in enumerate(zip(pieces, starts)):
+        piece = piece.astype(np.float64)
+        if k > 0 and fade:
+            ramp = (np.arange(2 * fade) + 0.5) / (2 * fade)
+            piece[..., :2 * fade] *= ramp
+            stitched[..., start:start + 2 * fade] *= 1 - ramp
+        stitched[..., start:start + piece.shape[-1]] += piece
+    return stitched
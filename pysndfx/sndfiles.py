@@ -1,6 +1,12 @@
+import io
 import logging
-import shlex
-import wave
+import mmap
+import os
+import re
+import struct
+from collections import namedtuple
+from functools import lru_cache
+from stat import S_ISREG
 from subprocess import PIPE, Popen
 
 import numpy as np
@@ -11,89 +17,703 @@ ENCODINGS_MAPPING = {
     np.float64: 'f64',
 }
 
+# SoX options for encoding samples like these dtypes
+SAMPLE_ENCODINGS = {
+    np.int16: ['-e', 'signed-integer', '-b', '16'],
+    np.float32: ['-e', 'floating-point', '-b', '32'],
+    np.float64: ['-e', 'floating-point', '-b', '64'],
+}
+
 PIPE_CHAR = '-'
 
+CHUNK_FRAMES = 65536  # frames interleaved at a time when an array isn't laid out as SoX expects
+
 logger = logging.getLogger('pysndfx')
 
+SoundFileInfo = namedtuple('SoundFileInfo', ['channels', 'rate', 'length', 'encoding'])
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def read_wav_header(fp, size=None):
+    """Read a WAV header, `size` is the size of the whole file if known.
+
+    The length in the data chunk's header is trusted only as far as the
+    file goes, since streamed WAVs carry a placeholder and truncated files
+    claim more data than they have.
+    """
+    file_size = size
+    riff, _, wave_id = struct.unpack('<4sI4s', fp.read(12))
+    if riff != b'RIFF' or wave_id != b'WAVE':
+        return None
+    fmt = None
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            return None
+        chunk_id, size = struct.unpack('<4sI', header)
+        if chunk_id == b'fmt ':
+            chunk = fp.read(size + size % 2)
+            fmt = struct.unpack('<HHIIHH', chunk[:16])
+            if fmt[0] == WAVE_FORMAT_EXTENSIBLE and len(chunk) >= 26:
+                fmt = (struct.unpack('<H', chunk[24:26])[0],) + fmt[1:]
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            tag, channels, rate, _, block_align, bits = fmt
+            if tag == WAVE_FORMAT_PCM:
+                encoding = ('u' if bits == 8 else 's') + str(bits)
+            elif tag == WAVE_FORMAT_IEEE_FLOAT:
+                encoding = 'f' + str(bits)
+            else:
+                return None  # compressed WAV (ADPCM, GSM...), let SoX figure it out
+            length = size // block_align if size != 0xFFFFFFFF and block_align else None
+            if length is not None and file_size is not None:
+                length = min(length, max(file_size - fp.tell(), 0) // block_align)
+            return SoundFileInfo(channels, rate, length, encoding)
+        else:
+            fp.seek(size + size % 2, os.SEEK_CUR)
+
+
+def _read_extended(data):
+    """Decode an 80-bit IEEE 754 extended precision float, used for AIFF sample rates."""
+    exponent, mantissa = struct.unpack('>HQ', data)
+    sign = -1 if exponent & 0x8000 else 1
+    exponent &= 0x7FFF
+    if exponent == 0 and mantissa == 0:
+        return 0.0
+    return sign * mantissa * 2.0 ** (exponent - 16383 - 63)
+
+
+def read_aiff_header(fp):
+    form, _, form_type = struct.unpack('>4sI4s', fp.read(12))
+    if form != b'FORM' or form_type not in (b'AIFF', b'AIFC'):
+        return None
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            return None
+        chunk_id, size = struct.unpack('>4sI', header)
+        if chunk_id == b'COMM':
+            chunk = fp.read(size + size % 2)
+            channels, length, bits = struct.unpack('>hIh', chunk[:8])
+            rate = _read_extended(chunk[8:18])
+            compression = chunk[18:22] if form_type == b'AIFC' else b'NONE'
+            if compression in (b'NONE', b'twos', b'sowt'):
+                encoding = 's' + str(bits)
+            elif compression in (b'fl32', b'FL32'):
+                encoding = 'f32'
+            elif compression in (b'fl64', b'FL64'):
+                encoding = 'f64'
+            else:
+                return None
+            return SoundFileInfo(channels, int(rate) if rate == int(rate) else rate, length, encoding)
+        fp.seek(size + size % 2, os.SEEK_CUR)
+
+
+def read_flac_header(fp):
+    if fp.read(4) != b'fLaC':
+        return None
+    block_header = fp.read(4)
+    if len(block_header) < 4 or block_header[0] & 0x7F != 0:  # STREAMINFO must come first
+        return None
+    streaminfo = fp.read(34)
+    if len(streaminfo) < 18:
+        return None
+    packed, = struct.unpack('>Q', streaminfo[10:18])
+    rate = packed >> 44
+    channels = ((packed >> 41) & 0x7) + 1
+    bits = ((packed >> 36) & 0x1F) + 1
+    length = packed & 0xFFFFFFFFF
+    return SoundFileInfo(channels, rate, length or None, 'flac' + str(bits))
+
+
+def _last_ogg_granule(fp):
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    fp.seek(max(0, size - 65536))
+    tail = fp.read()
+    page = tail.rfind(b'OggS')
+    if page < 0 or len(tail) < page + 14:
+        return None
+    granule, = struct.unpack('<q', tail[page + 6:page + 14])
+    return granule if granule >= 0 else None
+
+
+def read_ogg_header(fp):
+    page = fp.read(27)
+    if len(page) < 27 or page[:4] != b'OggS':
+        return None
+    segments = fp.read(page[26])
+    packet = fp.read(sum(segments))
+    if packet[:7] == b'\x01vorbis' and len(packet) >= 16:
+        channels, rate = struct.unpack('<BI', packet[11:16])
+        granule = _last_ogg_granule(fp)
+        return SoundFileInfo(channels, rate, granule, 'vorbis')
+    if packet[:8] == b'OpusHead' and len(packet) >= 12:
+        channels, pre_skip = struct.unpack('<BH', packet[9:12])
+        granule = _last_ogg_granule(fp)
+        return SoundFileInfo(channels, 48000, max(granule - pre_skip, 0) if granule is not None else None, 'opus')
+    return None
+
+
+HEADER_READERS = {
+    b'RIFF': read_wav_header,
+    b'FORM': read_aiff_header,
+    b'fLaC': read_flac_header,
+    b'OggS': read_ogg_header,
+}
+
+
+def read_header(fp, size=None):
+    """Read channels, rate, length and encoding from the header of a sound file.
+
+    Supports WAV, AIFF/AIFC, FLAC and Ogg Vorbis/Opus. Returns None for
+    anything else, or for headers that can't be parsed. `size` is the size
+    of the whole file, if known.
+    """
+    reader = HEADER_READERS.get(fp.read(4))
+    if reader is None:
+        return None
+    fp.seek(-4, os.SEEK_CUR)
+    try:
+        return reader(fp, size) if reader is read_wav_header else reader(fp)
+    except (struct.error, ValueError, IndexError):
+        return None
+
+
+def sniff_type(prefix):
+    """Guess SoX's name for the type of a sound file from its first bytes, or None."""
+    magic = prefix[:4]
+    if magic == b'RIFF':
+        return 'wav'
+    if magic == b'FORM':
+        return 'aifc' if prefix[8:12] == b'AIFC' else 'aiff'
+    if magic == b'fLaC':
+        return 'flac'
+    if magic == b'OggS':
+        return 'opus' if b'OpusHead' in prefix[:512] else 'ogg'
+    if prefix[:3] == b'ID3' or len(prefix) > 1 and prefix[0] == 0xFF and prefix[1] & 0xE0 == 0xE0:
+        return 'mp3'
+    return None
+
+
+def sample_dtype(encoding):
+    """The ndarray dtype to decode samples of an encoding to: int16 if that's lossless, float32 otherwise."""
+    return np.int16 if encoding in ('u8', 's8', 's16', 'flac8', 'flac16') else np.float32
+
+
+def sox_info(filepath, prefix=None, filetype=None):
+    """Ask SoX for the channels, rate, length and encoding of a sound file.
+
+    With `prefix`, the first bytes of a file of type `filetype` are piped to
+    SoX instead of having it read `filepath`.
+    """
+    if prefix is not None:
+        info_cmd = ['sox', '--i', '-t', filetype, PIPE_CHAR]
+    else:
+        info_cmd = ['sox', '--i', filepath]
+    logger.debug("Running info command : %s" % info_cmd)
+    stdout, stderr = Popen(info_cmd, stdin=PIPE if prefix is not None else None, stdout=PIPE,
+                           stderr=PIPE).communicate(prefix)
+    fields = dict(line.split(':', 1) for line in stdout.decode(errors='replace').splitlines() if ':' in line)
+    fields = {key.strip(): value.strip() for key, value in fields.items()}
+    if 'Channels' not in fields:
+        raise RuntimeError(stderr.decode() or "Couldn't read %s" % filepath)
+    rate = float(fields['Sample Rate'])
+    samples = re.search(r'= (\d+) samples', fields.get('Duration', ''))
+    encoding = fields.get('Sample Encoding', '').lower()
+    pcm = re.match(r'(\d+)-bit (signed integer|floating point) pcm', encoding)
+    if pcm:
+        encoding = ('s' if pcm.group(2) == 'signed integer' else 'f') + pcm.group(1)
+    return SoundFileInfo(
+        int(fields['Channels']),
+        int(rate) if rate == int(rate) else rate,
+        int(samples.group(1)) if samples else None,
+        encoding,
+    )
+
+
+@lru_cache(maxsize=4096)
+def _cached_info(filepath, size, mtime):
+    with open(filepath, 'rb') as fp:
+        info = read_header(fp, size)
+    if info is None:
+        info = sox_info(filepath)
+    return info
+
+
+def probe(filepath):
+    """Return the SoundFileInfo of a sound file.
+
+    Common containers are parsed in-process, anything else is handed to
+    `sox --i`. Results are cached on the file's path, size and modification
+    time.
+    """
+    try:
+        stat = os.stat(filepath)
+    except OSError:  # not a regular file (an URL, a device...), SoX might still know what to do with it
+        return sox_info(filepath)
+    return _cached_info(filepath, stat.st_size, stat.st_mtime_ns)
+
+
+def interleaved_chunks(snd_array, chunk_frames=CHUNK_FRAMES):
+    """Yield the samples of a 1-D or (channels, n) array as interleaved raw bytes.
+
+    An array whose memory is already interleaved (1-D and contiguous, or a
+    Fortran ordered (channels, n) array like the transpose of a C ordered
+    (n, channels) array) is passed on as a single memoryview without copying.
+    Anything else is interleaved `chunk_frames` frames at a time, so a full
+    size copy of the array is never made.
+    """
+    frames = snd_array.T  # (n,) or (n, channels), C contiguous when already interleaved
+    if frames.flags.c_contiguous and isinstance(snd_array, np.memmap):
+        # windows of a memory map, so pages are read (and can be dropped again) as SoX consumes them
+        mapping = getattr(snd_array, '_mmap', None)
+        if mapping is not None and hasattr(mapping, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapping.madvise(mmap.MADV_SEQUENTIAL)
+        for start in range(0, len(frames), chunk_frames):
+            yield memoryview(frames[start:start + chunk_frames]).cast('B')
+        return
+    if frames.flags.c_contiguous:
+        yield memoryview(frames).cast('B')
+        return
+    for start in range(0, len(frames), chunk_frames):
+        yield memoryview(np.ascontiguousarray(frames[start:start + chunk_frames])).cast('B')
+
 
 class SoxInput(object):
     pipe = '-'
 
     def __init__(self):
         self.cmd_prefix = None
+        # everything but the file path that determines cmd_prefix, paths always come last in cmd_prefix
+        self.signature = None
+        self.filepath = None
+        self.rate = None
+        self.length = None  # in frames, None if unknown
+
+    def chunks(self):
+        """Return the bytes-like chunks to write to SoX's stdin, or None if SoX reads the input itself."""
+        return None
 
 
 class FilePathInput(SoxInput):
     def __init__(self, filepath):
         super(FilePathInput, self).__init__()
-        info_cmd = 'sox --i -c ' + filepath
-        logger.debug("Running info command : %s" % info_cmd)
-        stdout, stderr = Popen(shlex.split(info_cmd, posix=False), stdout=PIPE, stderr=PIPE).communicate()
-        self.channels = int(stdout)
-        self.cmd_prefix = filepath
+        self.info = probe(filepath)
+        self.channels = self.info.channels
+        self.rate = self.info.rate
+        self.length = self.info.length
+        self.cmd_prefix = [filepath]
+        self.signature = ('path',)
+        self.filepath = filepath
+
+
+def _file_size(fp, prefix):
+    """The size of the file behind a file object `prefix` has been read from, or None if it can't be told."""
+    try:
+        stat = os.fstat(fp.fileno())
+        position = fp.tell()
+    except (AttributeError, OSError, ValueError):  # io.UnsupportedOperation is both
+        return None
+    if not S_ISREG(stat.st_mode):
+        return None
+    return stat.st_size - (position - len(prefix))
 
 
 class FileBufferInput(SoxInput):
-    def __init__(self, fp):
+    """Pipes a readable file object to SoX, which decodes it.
+
+    The type of the file is sniffed from its first bytes unless `filetype`
+    is given, and its channels, rate and encoding are read from the header
+    in those bytes. Everything is then copied to SoX's stdin PREFIX_SIZE
+    bytes at a time, so the object doesn't need to be seekable (sockets and
+    HTTP responses work too) and memory use doesn't grow with its length.
+    """
+
+    PREFIX_SIZE = 65536  # bytes read up front to find the header, and copied at a time afterwards
+
+    def __init__(self, fp, filetype=None):
         super(FileBufferInput, self).__init__()
-        wave_file = wave.open(fp, mode='rb')  # wave.open() seems to support only 16bit encodings
-        self.channels = wave_file.getnchannels()
-        self.data = np.frombuffer(wave_file.readframes(wave_file.getnframes()), dtype=np.int16)
-        self.cmd_prefix = ' '.join([
-            '-t s16',  # int16 encoding by default
-            '-r ' + str(wave_file.getframerate()),
-            '-c ' + str(self.channels),
-            PIPE_CHAR,
-        ])
+        self.fp = fp
+        self.prefix = b''
+        while len(self.prefix) < self.PREFIX_SIZE:
+            data = fp.read(self.PREFIX_SIZE - len(self.prefix))
+            if not data:
+                break
+            self.prefix += data
+        complete = len(self.prefix) < self.PREFIX_SIZE
+        self.filetype = filetype or sniff_type(self.prefix)
+        if self.filetype is None:
+            raise ValueError("Can't tell the type of the file buffer, please specify it.")
+
+        self.info = read_header(io.BytesIO(self.prefix), len(self.prefix) if complete else _file_size(fp, self.prefix))
+        if self.info is None:
+            self.info = sox_info(None, self.prefix, self.filetype)
+        self.channels = self.info.channels
+        self.rate = self.info.rate
+        # only these headers carry the length up front, others are only known once the whole file has been read
+        self.length = self.info.length if complete or self.filetype in ('wav', 'aiff', 'aifc', 'flac') else None
+        self.cmd_prefix = ['-t', self.filetype, PIPE_CHAR]
+        self.signature = ('buffer', self.filetype)
+
+    def chunks(self):
+        yield self.prefix
+        while True:
+            data = self.fp.read(self.PREFIX_SIZE)
+            if not data:
+                break
+            yield data
 
 
 class NumpyArrayInput(SoxInput):
     def __init__(self, snd_array, rate):
         super(NumpyArrayInput, self).__init__()
-        self.channels = snd_array.ndim
-        self.cmd_prefix = ' '.join([
-            '-t ' + ENCODINGS_MAPPING[snd_array.dtype.type],
-            '-r ' + str(rate),
-            '-c ' + str(self.channels),
+        self.snd_array = snd_array
+        self.channels = snd_array.shape[0] if snd_array.ndim > 1 else 1
+        self.rate = rate
+        self.length = snd_array.shape[-1]
+        self.cmd_prefix = [
+            '-t', ENCODINGS_MAPPING[snd_array.dtype.type],
+            '-r', str(rate),
+            '-c', str(self.channels),
             PIPE_CHAR,
-        ])
+        ]
+        self.signature = ('array', snd_array.dtype.type, rate, self.channels)
+
+    def chunks(self):
+        return interleaved_chunks(self.snd_array)
+
+
+class RawPipeInput(SoxInput):
+    """Raw samples SoX reads from a pipe set up by the caller, e.g. another SoX process's stdout."""
+
+    def __init__(self, encoding, rate, channels):
+        super(RawPipeInput, self).__init__()
+        self.channels = channels
+        self.rate = rate
+        self.cmd_prefix = ['-t', ENCODINGS_MAPPING[encoding], '-r', str(rate), '-c', str(channels), PIPE_CHAR]
+        self.signature = ('raw', encoding, rate, channels)
 
 
 class SoxOutput(object):
     def __init__(self):
         self.cmd_suffix = None
+        # everything but the file path that determines cmd_suffix, paths always come last in cmd_suffix
+        self.signature = None
+        self.filepath = None
+        self.rate = None
+        self.frame_size = None  # in bytes, for raw outputs
+        self.nbytes = 0  # read from SoX's stdout so far
+
+    def read(self, pipe):
+        """Consume SoX's stdout and return what the call should return."""
+        data = pipe.read()
+        self.nbytes = len(data)
+        return self.finish(data)
+
+    async def read_async(self, stream):
+        data = await stream.read()
+        self.nbytes = len(data)
+        return self.finish(data)
+
+    def finish(self, data):
+        return None
+
+    def check(self, stderr):
+        """Return the part of SoX's stderr that means the call failed."""
+        return stderr
 
 
 class FilePathOutput(SoxOutput):
     def __init__(self, filepath, samplerate, channels):
         super(FilePathOutput, self).__init__()
-        self.cmd_suffix = ' '.join(['-r ' + str(samplerate), '-c ' + str(channels), filepath])
+        self.rate = samplerate
+        self.cmd_suffix = ['-r', str(samplerate), '-c', str(channels), filepath]
+        self.signature = ('path', samplerate, channels)
+        self.filepath = filepath
 
 
 class FileBufferOutput(SoxOutput):
-    def __init__(self, fp, samplerate, channels):
+    """Copies audio encoded by SoX to a writable file object as it arrives.
+
+    SoX encodes to `filetype` (a WAV file by default, or whatever the
+    extension of the object's name says), with the sample encoding of the
+    `encoding` dtype if given. WAV files are 16 bit by default, as they
+    always used to be. The output is copied COPY_SIZE bytes at a time
+    and flushed, so a socket or HTTP response can start sending audio before
+    SoX is done. SoX can't fill in the length fields of a WAV header it
+    writes to a pipe, so they're patched when the object is seekable.
+    """
+
+    COPY_SIZE = 65536
+    HEADER_SIZE = 4096  # bytes of the output kept to find the WAV header's length fields
+    UNSEEKABLE_WARNING = b"can't seek"
+
+    def __init__(self, fp, samplerate, channels, filetype=None, encoding=None):
         super(FileBufferOutput, self).__init__()
-        self.writer = wave.open(fp, mode='wb')
-        self.writer.setnchannels(channels)
-        self.writer.setframerate(samplerate)
-        self.writer.setsampwidth(2)
-        self.cmd_suffix = ' '.join([
-            '-t ' + ENCODINGS_MAPPING[np.int16],
-            '-r ' + str(samplerate),
-            '-c ' + str(channels),
+        if filetype is None:
+            name = getattr(fp, 'name', None)
+            extension = os.path.splitext(name)[1][1:].lower() if isinstance(name, str) else ''
+            filetype = extension or 'wav'
+        self.fp = fp
+        self.filetype = filetype
+        self.channels = channels
+        self.rate = samplerate
+        self.seekable = fp.seekable() if hasattr(fp, 'seekable') else False
+        self.start = fp.tell() if self.seekable else None
+        self.header = b''
+        self.cmd_suffix = ['-t', filetype]
+        if encoding is None and filetype == 'wav':
+            encoding = np.int16
+        if encoding is not None:
+            self.cmd_suffix += SAMPLE_ENCODINGS[encoding]
+        self.cmd_suffix += [
+            '-r', str(samplerate),
+            '-c', str(channels),
             PIPE_CHAR,
-        ])
+        ]
+        self.signature = ('buffer', filetype, encoding, samplerate, channels)
 
     def write(self, data):
-        self.writer.writeframesraw(data)
+        if len(self.header) < self.HEADER_SIZE:
+            self.header += bytes(data[:self.HEADER_SIZE - len(self.header)])
+        self.fp.write(data)
+        if hasattr(self.fp, 'flush'):
+            self.fp.flush()
+        self.nbytes += len(data)
+
+    def read(self, pipe):
+        while True:
+            data = pipe.read1(self.COPY_SIZE)
+            if not data:
+                break
+            self.write(data)
+        return self.finish(None)
+
+    async def read_async(self, stream):
+        while True:
+            data = await stream.read(self.COPY_SIZE)
+            if not data:
+                break
+            self.write(data)
+        return self.finish(None)
+
+    def finish(self, data):
+        if self.seekable and self.filetype == 'wav' and self.header[:4] == b'RIFF':
+            self.patch_wav_header()
+        return None
+
+    def patch_wav_header(self):
+        end = self.fp.tell()
+        fields = [(4, self.nbytes - 8)]  # RIFF size
+        block_align = fact = None
+        offset = 12
+        while offset + 8 <= len(self.header):
+            chunk_id = self.header[offset:offset + 4]
+            size, = struct.unpack('<I', self.header[offset + 4:offset + 8])
+            if chunk_id == b'fmt ' and offset + 22 <= len(self.header):
+                block_align, = struct.unpack('<H', self.header[offset + 20:offset + 22])
+            elif chunk_id == b'fact':
+                fact = offset + 8
+            elif chunk_id == b'data':
+                data_size = self.nbytes - offset - 8
+                fields.append((offset + 4, data_size))
+                if block_align and fact is not None:
+                    fields.append((fact, data_size // block_align))
+                break
+            offset += 8 + size + (size & 1)
+        for position, value in fields:
+            self.fp.seek(self.start + position)
+            self.fp.write(struct.pack('<I', min(value, 0xFFFFFFFF)))
+        self.fp.seek(end)
+
+    def check(self, stderr):
+        """Drop SoX's warning about the WAV header, which is patched when possible."""
+        return b''.join(line for line in stderr.splitlines(True) if self.UNSEEKABLE_WARNING not in line)
+
+
+def check_out(out, encoding, channels, frames=None):
+    """Raise ValueError unless `out` can hold an output of `encoding` samples, `channels` and `frames`."""
+    if out.dtype.type is not encoding:
+        raise ValueError("out has dtype %s, expected %s." % (out.dtype, np.dtype(encoding)))
+    if (out.ndim != 1 if channels == 1 else out.ndim != 2 or out.shape[0] != channels):
+        raise ValueError("out must have shape %s." % ('(n,)' if channels == 1 else '(%d, n)' % channels))
+    if not out.flags.writeable or not out.T.flags.c_contiguous:
+        raise ValueError("out must be writable with interleaved (Fortran ordered) memory.")
+    if frames is not None and out.shape[-1] < frames:
+        raise ValueError("out is too small for the output.")
 
 
 class NumpyArrayOutput(SoxOutput):
-    def __init__(self, encoding, samplerate, channels):
+    """Reads SoX's raw output straight into an ndarray.
+
+    The output is read with readinto() into `out` when given, which must be
+    a writable 1-D (mono) or (channels, n) array with interleaved memory
+    (i.e. Fortran ordered) and a large enough `n`. Otherwise a buffer of
+    `length` frames is preallocated when the output length can be estimated
+    up front. Effects with tails (echo, reverb...) overrun the estimate by a
+    little, so it's then grown in steps of GROWTH of it, and geometrically
+    when there's no estimate. The buffer is resized in place where the
+    allocator can, and trimmed to the output once it's complete.
+    """
+
+    GROWTH = 0.125  # of the estimated length
+
+    def __init__(self, encoding, samplerate, channels, out=None, length=None):
         super(NumpyArrayOutput, self).__init__()
-        self.cmd_suffix = ' '.join([
-            '-t ' + ENCODINGS_MAPPING[encoding],
-            '-r ' + str(samplerate),
-            '-c ' + str(channels),
+        self.encoding = encoding
+        self.channels = channels
+        self.rate = samplerate
+        self.frame_size = np.dtype(encoding).itemsize * channels
+        self.cmd_suffix = [
+            '-t', ENCODINGS_MAPPING[encoding],
+            '-r', str(samplerate),
+            '-c', str(channels),
+            PIPE_CHAR,
+        ]
+        self.signature = ('array', encoding, samplerate, channels)
+
+        if out is not None:
+            check_out(out, encoding, channels)
+            self.buffer = out.T.reshape(-1)  # a view, since the memory is contiguous
+        else:
+            # one spare frame, so the end of the output is noticed without growing the buffer
+            self.buffer = np.empty(((length or CHUNK_FRAMES) + 1) * channels, dtype=encoding)
+        self.out = out
+        self.length = length
+
+    def _free_space(self):
+        view = memoryview(self.buffer).cast('B')[self.nbytes:]
+        if view or self.out is not None:
+            return view
+        view.release()
+        if self.length:
+            step = max(CHUNK_FRAMES, int(self.length * self.GROWTH)) * self.channels
+        else:
+            step = len(self.buffer)
+        # no views of the buffer are left, callers release theirs
+        self.buffer.resize(len(self.buffer) + step, refcheck=False)
+        return memoryview(self.buffer).cast('B')[self.nbytes:]
+
+    def read(self, pipe):
+        while True:
+            with self._free_space() as view:
+                if not view:  # out is full, anything else would be lost
+                    if pipe.read(1):
+                        raise ValueError("out is too small for the output.")
+                    break
+                n = pipe.readinto(view)
+            if not n:
+                break
+            self.nbytes += n
+        return self.result()
+
+    async def read_async(self, stream):
+        while True:
+            with self._free_space() as view:
+                if not view:
+                    if await stream.read(1):
+                        raise ValueError("out is too small for the output.")
+                    break
+                data = await stream.read(len(view))
+                if not data:
+                    break
+                view[:len(data)] = data
+            self.nbytes += len(data)
+        return self.result()
+
+    def result(self):
+        if not self.nbytes:
+            return None
+        frames = self.nbytes // self.frame_size
+        if self.out is not None:
+            return self.out[..., :frames]
+        self.buffer.resize(frames * self.channels, refcheck=False)  # don't keep unused space alive
+        outsound = self.buffer
+        if self.channels > 1:
+            outsound = outsound.reshape((self.channels, frames), order='F')
+        return outsound
+
+
+class NpyFileOutput(SoxOutput):
+    """Streams SoX's raw output into a .npy file and returns it memory-mapped.
+
+    The samples are copied to the file as they arrive, so outputs larger
+    than memory can be produced. The header is written with a placeholder
+    shape of a fixed size and patched once the length is known. Multichannel
+    outputs are stored as Fortran ordered (channels, n) arrays, which is how
+    SoX interleaves them.
+    """
+
+    HEADER_SIZE = 128  # magic, version, header length and the padded header dict
+    COPY_SIZE = 1 << 20  # bytes copied at a time
+
+    def __init__(self, filepath, encoding, samplerate, channels):
+        super(NpyFileOutput, self).__init__()
+        self.encoding = encoding
+        self.channels = channels
+        self.rate = samplerate
+        self.frame_size = np.dtype(encoding).itemsize * channels
+        self.cmd_suffix = [
+            '-t', ENCODINGS_MAPPING[encoding],
+            '-r', str(samplerate),
+            '-c', str(channels),
             PIPE_CHAR,
-        ])
+        ]
+        self.signature = ('npy', encoding, samplerate, channels)
+        self.path = filepath  # not filepath, SoX writes to its stdout and the samples are copied from there
+
+    def header(self, frames):
+        shape = (frames,) if self.channels == 1 else (self.channels, frames)
+        header = "{'descr': %r, 'fortran_order': %r, 'shape': %r, }" % (
+            np.dtype(self.encoding).str, self.channels > 1, shape)
+        header = header.ljust(self.HEADER_SIZE - 10 - 1) + '\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+    def read(self, pipe):
+        with open(self.path, 'wb') as f:
+            f.write(self.header(0))
+            buffer = bytearray(self.COPY_SIZE)
+            while True:
+                n = pipe.readinto(buffer)
+                if not n:
+                    break
+                f.write(memoryview(buffer)[:n])
+                self.nbytes += n
+            return self.result(f)
+
+    async def read_async(self, stream):
+        with open(self.path, 'wb') as f:
+            f.write(self.header(0))
+            while True:
+                data = await stream.read(self.COPY_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                self.nbytes += len(data)
+            return self.result(f)
+
+    def result(self, f):
+        frames = self.nbytes // self.frame_size
+        f.truncate(self.HEADER_SIZE + frames * self.frame_size)
+        f.seek(0)
+        f.write(self.header(frames))
+        f.close()
+        if not frames:
+            return None
+        return np.load(self.path, mmap_mode='r+')
+
+
+class RawPipeOutput(SoxOutput):
+    """Raw samples SoX writes to its stdout for the caller to pass on, e.g. to another SoX process."""
+
+    def __init__(self, encoding, samplerate, channels):
+        super(RawPipeOutput, self).__init__()
+        self.rate = samplerate
+        self.frame_size = np.dtype(encoding).itemsize * channels
+        self.cmd_suffix = ['-t', ENCODINGS_MAPPING[encoding], '-r', str(samplerate), '-c', str(channels), PIPE_CHAR]
+        self.signature = ('raw', encoding, samplerate, channels)
@@ -0,0 +1,86 @@
+"""Parsing the report of SoX's stats effect.
+
+SoX prints the report to stderr, with a column for all channels together
+(Overall) followed by a column per channel when there's more than one.
+"""
+from collections import namedtuple
+
+ChannelStats = namedtuple('ChannelStats', [
+    'dc_offset',
+    'min_level',
+    'max_level',
+    'peak_db',
+    'rms_db',
+    'rms_peak_db',
+    'rms_trough_db',
+    'crest_factor',
+    'flat_factor',
+    'peak_count',
+    'bit_depth',
+    'clipped',
+])
+
+Stats = namedtuple('Stats', ['overall', 'channels', 'samples', 'length'])
+
+# labels of the per channel rows of the report, in the order of ChannelStats' fields (all but clipped)
+ROWS = (
+    'DC offset',
+    'Min level',
+    'Max level',
+    'Pk lev dB',
+    'RMS lev dB',
+    'RMS Pk dB',
+    'RMS Tr dB',
+    'Crest factor',
+    'Flat factor',
+    'Pk count',
+    'Bit-depth',
+)
+
+SUMMARY_ROWS = ('Num samples', 'Length s', 'Scale max', 'Window s')
+
+SUFFIXES = {'k': 1e3, 'M': 1e6, 'G': 1e9}
+
+
+def _number(value):
+    if value == '-':
+        return None
+    if value[-1] in SUFFIXES:
+        return float(value[:-1]) * SUFFIXES[value[-1]]
+    try:
+        return float(value)
+    except ValueError:
+        return value  # e.g. a bit depth of 16/16
+
+
+def _clipped(stats):
+    """Number of samples at full scale in a channel, a sign of clipping."""
+    peak = max(abs(stats.min_level), abs(stats.max_level))
+    return int(stats.peak_count) if peak >= 1 - 2 ** -15 else 0
+
+
+def parse_stats(stderr):
+    """Split SoX's stderr into the stats report and everything else.
+
+    Returns a Stats (None if there was no report) and the remaining bytes,
+    which are SoX's warnings and errors. The Stats' samples is None.
+    """
+    rows = {}
+    rest = []
+    for line in stderr.decode(errors='replace').splitlines(True):
+        label = next((row for row in ROWS + SUMMARY_ROWS if line.startswith(row + ' ')), None)
+        if label is not None:
+            rows[label] = [_number(value) for value in line[len(label):].split()]
+        elif not line.strip() or line.split()[0] == 'Overall':
+            continue
+        else:
+            rest.append(line)
+    if not rows:
+        return None, stderr
+    columns = [ChannelStats(*column, clipped=None) for column in zip(*(rows[row] for row in ROWS))]
+    columns = [column._replace(peak_count=int(column.peak_count), clipped=_clipped(column)) for column in columns]
+    overall = columns[0]
+    channels = columns[1:] or [overall]
+    # SoX rounds the number of samples to 3 significant figures, so callers fill in an exact count if they know it
+    length = rows.get('Length s', [None])[0]
+    return Stats(overall, channels, None, length), ''.join(rest).encode()
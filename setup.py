@@ -18,13 +18,19 @@ setup(
         'Intended Audience :: Developers',
         'Topic :: Multimedia :: Sound/Audio',
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.7',
     ],
     keywords='audio music sound',
     packages=['pysndfx'],
+    python_requires='>=3.7',
     install_requires=['numpy'],
-    extras_require={'test': ['pytest', 'flake8', 'flake8-isort', 'flake8-bugbear', 'librosa', 'soundfile']},
+    extras_require={
+        'test': ['pytest', 'flake8', 'flake8-isort', 'flake8-bugbear', 'librosa', 'soundfile'],
+        'benchmark': ['asv', 'virtualenv'],
+        'yaml': ['pyyaml'],
+    },
+    entry_points={
+        'console_scripts': ['pysndfx = pysndfx.cli:main'],
+    },
 )
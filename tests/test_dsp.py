@@ -1,10 +1,26 @@
 """Testing module for the DSP package, preferably run with py.test."""
+import asyncio
+import io
 import logging
+import pickle
 
 import librosa as lr
+import numpy as np
+import pytest
 import soundfile as sf
 
+from pysndfx import (
+    NoiseProfileStore,
+    Pipeline,
+    ResultCache,
+    analyze,
+    cli,
+    libsox,
+    metrics,
+)
 from pysndfx.dsp import AudioEffectsChain
+from pysndfx.optimizer import optimize
+from pysndfx.sndfiles import probe, sox_info
 
 logger = logging.getLogger('pysndfx')
 logger.setLevel(logging.DEBUG)
@@ -56,3 +72,307 @@ def test_file_to_ndarray():
     y = apply_audio_effects(infile)
     sf.write('test_file_to_ndarray.wav', y.T, sr)
     assert lr.util.valid_audio(y, mono=False)
+
+
+def test_map():
+    results = list(apply_audio_effects.map([mono, stereo, infile, 'missing.wav'], workers=2))
+    assert [r.index for r in results] == [0, 1, 2, 3]
+    for result in results[:3]:
+        assert result.error is None
+        assert lr.util.valid_audio(result.output, mono=False)
+    assert results[3].error is not None
+
+
+def test_stream():
+    blocks = (stereo[:, i:i + sr] for i in range(0, stereo.shape[1], sr))
+    processed = list(apply_audio_effects.stream(blocks, sample_in=sr, block_size=4096))
+    assert all(block.shape == (2, 4096) for block in processed[:-1])
+    y = np.concatenate(processed, axis=1)
+    sf.write('test_stream.wav', y.T, sr)
+    assert lr.util.valid_audio(y, mono=False)
+
+
+def test_apply_async():
+    async def apply_all():
+        limiter = asyncio.Semaphore(2)
+        return await asyncio.gather(*(apply_audio_effects.apply_async(x, limiter=limiter) for x in (mono, stereo, infile)))
+
+    for y in asyncio.run(apply_all()):
+        assert lr.util.valid_audio(y, mono=False)
+
+
+def test_compile():
+    compiled = apply_audio_effects.compile()
+    assert compiled == pickle.loads(pickle.dumps(compiled))
+    assert hash(compiled) == hash(apply_audio_effects.compile())
+    assert np.allclose(compiled(stereo), apply_audio_effects(stereo))
+
+
+def test_probe():
+    info = sf.info(infile)
+    assert probe(infile) == (info.channels, info.samplerate, info.frames, 'vorbis')
+    assert probe(infile) == sox_info(infile)[:3] + ('vorbis',)
+
+
+def test_probe_truncated_wav(tmpdir):
+    path = str(tmpdir.join('x.wav'))
+    sf.write(path, stereo.T[:sr], sr, subtype='PCM_16')
+    with open(path, 'rb') as f:
+        data = f.read()
+    truncated = str(tmpdir.join('truncated.wav'))
+    with open(truncated, 'wb') as f:
+        f.write(data[:len(data) - 4 * (sr // 2)])  # the header still claims a second
+    assert probe(path).length == sr
+    assert probe(truncated).length == sr - sr // 2
+
+
+def test_ndarray_layouts():
+    y = apply_audio_effects(stereo)
+    assert np.allclose(apply_audio_effects(np.asfortranarray(stereo)), y)
+    assert np.allclose(apply_audio_effects(np.ascontiguousarray(stereo.T).T), y)
+
+
+def test_out():
+    out = np.empty((2, stereo.shape[1] + 2 * sr), dtype=stereo.dtype, order='F')
+    y = apply_audio_effects(stereo, out=out)
+    assert np.shares_memory(y, out)
+    assert np.allclose(y, apply_audio_effects(stereo))
+
+
+def test_numpy_backend():
+    def eq_chain(backend):
+        return AudioEffectsChain(backend=backend).highshelf().lowshelf().equalizer(1000, db=3).highpass(40).gain(-3)
+
+    y = eq_chain('numpy')(stereo)
+    assert y.dtype == stereo.dtype
+    assert np.allclose(y, eq_chain('sox')(stereo), atol=1e-6)
+    with pytest.raises(ValueError):
+        eq_chain('numpy')(stereo, out=np.empty((2, stereo.shape[1]), dtype=stereo.dtype))  # not interleaved
+    out = np.empty((2, stereo.shape[1]), dtype=np.float64, order='F')
+    assert np.allclose(eq_chain('numpy')(stereo, out=out), y, atol=1e-6)  # converted like SoX does
+
+
+def test_apply_batch():
+    fx = AudioEffectsChain().highshelf().phaser().lowshelf()
+    clips = [mono[:sr], mono[sr:3 * sr], mono[3 * sr:4 * sr]]
+    for y, clip in zip(fx.apply_batch(clips, sample_in=sr), clips):
+        assert np.allclose(y, fx(clip, sample_in=sr), atol=1e-6)
+    assert fx.apply_batch(np.stack([mono[:sr], mono[sr:2 * sr]]), sample_in=sr).shape == (2, sr)
+
+
+def test_metrics():
+    records = []
+    hook = metrics.add_hook(records.append)
+    try:
+        apply_audio_effects(stereo, sample_in=sr)
+        list(apply_audio_effects.stream([stereo], sample_in=sr))
+    finally:
+        metrics.remove_hook(hook)
+    assert [record.kind for record in records] == ['call', 'stream']
+    for record in records:
+        assert record.error is None
+        assert record.frames_in == stereo.shape[1]
+        assert record.bytes_in == stereo.nbytes
+        assert record.bytes_out == record.frames_out * 2 * stereo.itemsize
+        assert record.realtime_factor > 0
+        assert {'spawn', 'write', 'read', 'wait'} <= set(record.phases)
+
+
+def test_apply_parallel():
+    fx = AudioEffectsChain().highpass(60).lowpass(2000).echo(delays=[50], decays=[0.3])
+    y = fx.apply_parallel(stereo, segments=4, sample_in=sr)
+    expected = fx(stereo, sample_in=sr)
+    assert y.shape == expected.shape  # including echo's tail
+    assert np.allclose(y, expected, atol=1e-4)
+    with pytest.raises(ValueError):
+        AudioEffectsChain().reverse().apply_parallel(stereo, sample_in=sr)
+
+
+def test_optimized():
+    fx = AudioEffectsChain().gain(-3).highpass(40).equalizer(1000, db=0).gain(-6).vol(0.5).speed(2).speed(0.75)
+    optimized = fx.optimized()
+    assert optimized.effects == optimize(fx.compile().effects)[0]
+    assert [name for name, _ in optimized.effects] == ['vol', 'highpass', 'speed']
+    assert optimized.effects[-1] == ('speed', ('1.5',))
+    changes = optimize(fx.compile().effects)[1]
+    assert changes[0] == 'dropped equalizer 1000 1.0q 0'
+    assert changes[-1] == 'merged 2 speed effects into speed 1.5'
+    assert any(change.startswith('folded gain -3, gain -6, vol 0.5') for change in changes)
+    assert AudioEffectsChain().speed(2).speed(0.5).optimized().effects == ()
+    assert np.allclose(optimized(stereo, sample_in=sr), fx(stereo, sample_in=sr), atol=1e-4)
+
+
+def test_cache(tmpdir):
+    cache = ResultCache(str(tmpdir), max_bytes=stereo.nbytes * 3 // 2)
+    y = apply_audio_effects(stereo, sample_in=sr, cache=cache)
+    cached = apply_audio_effects(stereo, sample_in=sr, cache=cache)
+    assert isinstance(cached, np.memmap) and np.array_equal(cached, y)
+    apply_audio_effects(stereo[:, ::-1], sample_in=sr, cache=cache)  # evicts the first output
+    assert cache.stats['hits'] == 1 and cache.stats['misses'] == 2
+    assert cache.stats['bytes'] <= cache.max_bytes
+    assert cache.stats['bytes'] == sum(path.size() for path in tmpdir.listdir('*.npy'))
+
+
+def test_npy_output(tmpdir):
+    path = str(tmpdir.join('y.npy'))
+    y = apply_audio_effects(stereo, path, sample_in=sr)
+    assert isinstance(y, np.memmap)
+    assert np.array_equal(np.load(path), apply_audio_effects(stereo, sample_in=sr))
+    src = np.lib.format.open_memmap(str(tmpdir.join('x.npy')), 'w+', stereo.dtype, stereo.T.shape).T
+    src[:] = stereo
+    assert np.array_equal(apply_audio_effects(src, sample_in=sr), np.load(path))
+    compiled = apply_audio_effects.compile()
+    compiled(stereo, path, sample_in=sr)
+    assert np.array_equal(compiled(stereo, sample_in=sr), np.load(path))  # the .npy path isn't cached in argv
+
+
+def test_fan_out(tmpdir):
+    chains = [AudioEffectsChain().highpass(60), AudioEffectsChain().lowpass(2000).gain(-3)]
+    for y, fx in zip(AudioEffectsChain.fan_out(infile, chains), chains):
+        assert np.allclose(y, fx(infile), atol=1e-5)
+    wav = str(tmpdir.join('x.wav'))
+    sf.write(wav, stereo.T, sr, subtype='PCM_16')
+    for y, fx in zip(AudioEffectsChain.fan_out(wav, chains), chains):
+        assert y.dtype == np.float32
+        assert np.allclose(y, fx(wav), atol=1e-5)
+
+
+def test_live():
+    fx = AudioEffectsChain().highpass(60).lowpass(5000)
+    blocks = [stereo[:, i:i + 1024] for i in range(0, sr // 2, 1024)]
+    processed = []
+    report = fx.live(blocks, processed.append, sample_in=sr, buffer=4096, input_buffer=4096)
+    assert np.allclose(np.concatenate(processed, axis=-1), fx(np.concatenate(blocks, axis=-1), sample_in=sr))
+    assert len(report.latencies) == len(blocks)
+    assert 0 < report.p50 <= report.max
+
+
+@pytest.mark.skipif(not libsox.available(), reason='libsox is not installed')
+def test_libsox_backend():
+    def chain(backend):
+        return AudioEffectsChain(backend=backend).highshelf().reverb().phaser().delay().lowshelf()
+
+    assert np.allclose(chain('libsox')(stereo, sample_in=sr), chain('sox')(stereo, sample_in=sr), atol=1e-6)
+
+
+def test_file_buffer_input(tmpdir):
+    path = str(tmpdir.join('x.flac'))
+    sf.write(path, stereo.T, sr, subtype='PCM_24')
+    with open(path, 'rb') as f:
+        y = apply_audio_effects(f)
+    assert y.dtype == np.float32
+    assert np.allclose(y, apply_audio_effects(path), atol=1e-6)
+
+
+def test_file_buffer_output():
+    buffer = io.BytesIO()
+    assert apply_audio_effects(stereo, buffer, sample_in=sr, type_out='wav', encoding_out=np.float32) is None
+    y, rate = sf.read(io.BytesIO(buffer.getvalue()), dtype='float32')
+    assert rate == sr
+    assert np.array_equal(y.T, apply_audio_effects(stereo, sample_in=sr))
+    buffer = io.BytesIO()
+    apply_audio_effects(stereo, buffer, sample_in=sr)
+    assert sf.info(io.BytesIO(buffer.getvalue())).subtype == 'PCM_16'
+
+
+def test_cli(tmpdir):
+    spec = tmpdir.join('chain.json')
+    spec.write('["highshelf", {"lowpass": [3000]}, {"gain": {"db": -3}}]')
+    for name in ('a.wav', 'b.wav'):
+        sf.write(str(tmpdir.join('in', name).ensure()), stereo.T, sr)
+    args = [str(spec), str(tmpdir.join('in', '*.wav')), '-o', str(tmpdir.join('out')), '-w', '2', '--format', 'flac']
+    assert cli.main(args) == 0
+    expected = AudioEffectsChain().highshelf().lowpass(3000).gain(-3)(str(tmpdir.join('in', 'a.wav')))
+    y, _ = sf.read(str(tmpdir.join('out', 'a.flac')), dtype='float32')
+    assert np.allclose(y.T, expected, atol=1e-4)
+    assert cli.main(args) == 0  # everything is in the journal already
+
+
+def test_cli_shards(tmpdir):
+    spec = tmpdir.join('chain.json')
+    spec.write('[{"gain": [-3]}]')
+    inputs = [str(tmpdir.join('corpus', directory, 'x.wav').ensure()) for directory in ('a', 'b')]
+    for path in inputs:
+        sf.write(path, stereo.T, sr)
+    for index in range(2):
+        args = [str(spec)] + inputs + ['-o', str(tmpdir.join('out')), '-w', '1', '--shard-index', str(index),
+                                       '--shard-count', '2']
+        assert cli.main(args) == 0
+    for directory in ('a', 'b'):
+        assert tmpdir.join('out', directory, 'x.wav').check()
+    assert not tmpdir.join('out', 'x.wav').check()
+
+
+def test_with_stats():
+    y, stats = apply_audio_effects(stereo, sample_in=sr, with_stats=True)
+    assert np.array_equal(y, apply_audio_effects(stereo, sample_in=sr))
+    assert len(stats.channels) == 2
+    for channel, measured in zip(y, stats.channels):
+        assert np.isclose(measured.max_level, channel.max(), atol=1e-4)
+        assert np.isclose(measured.rms_db, 20 * np.log10(np.sqrt(np.mean(channel ** 2))), atol=0.05)
+    assert stats.samples == y.shape[1]
+    assert all(channel.clipped == 0 for channel in stats.channels)
+    _, stats = AudioEffectsChain().gain(40)(stereo, sample_in=sr, with_stats=True)
+    assert all(channel.clipped > 0 for channel in stats.channels)
+    assert analyze(stereo, sample_in=sr).samples == stereo.shape[1]
+
+
+def test_normalize_with_stats():
+    stats = analyze(stereo, sample_in=sr)
+    assert np.isclose(stats.overall.peak_db, 20 * np.log10(np.abs(stereo).max()), atol=0.01)
+    fx = AudioEffectsChain().normalize(-1, stats=stats)
+    assert fx.command[-2:] == ['gain', -1 - stats.overall.peak_db]
+    assert np.isclose(np.abs(fx(stereo, sample_in=sr)).max(), 10 ** (-1 / 20), atol=1e-3)
+    y = AudioEffectsChain().normalize(-20, stats=stats, measure='rms')(stereo, sample_in=sr)
+    assert np.isclose(20 * np.log10(np.sqrt(np.mean(y ** 2))), -20, atol=0.05)
+
+
+def test_noise_reduction(tmp_path):
+    rng = np.random.RandomState(0)
+    noise = (0.01 * rng.randn(sr)).astype(np.float32)
+    store = NoiseProfileStore(str(tmp_path))
+    profile = store.profile('mic', src=noise, sample_in=sr)
+    assert store.profile('mic') == profile
+    assert NoiseProfileStore(str(tmp_path)).get('mic') == profile
+    with pytest.raises(KeyError):
+        store.profile('other')
+    y = AudioEffectsChain().noise_reduction(profile, amount=0.5)(noise, sample_in=sr)
+    spaced = AudioEffectsChain().noise_reduction('/home/me/My Profiles/mic.prof', 0.3).compile()
+    assert spaced.command == ('noisered', '/home/me/My Profiles/mic.prof', '0.3')
+    assert np.sqrt(np.mean(y ** 2)) < np.sqrt(np.mean(noise ** 2)) / 2
+
+
+def test_pipeline():
+    first = AudioEffectsChain().highpass(100)
+    second = AudioEffectsChain().lowpass(3000)
+    blocks = []
+
+    def halve(block):
+        blocks.append(block.shape)
+        return block / 2
+
+    y = Pipeline(first, halve, second, block_size=4096)(stereo, sample_in=sr)
+    assert all(shape[0] == 2 and shape[1] <= 4096 for shape in blocks)
+    assert np.allclose(y, second(first(stereo, sample_in=sr) / 2, sample_in=sr), atol=1e-5)
+    both = AudioEffectsChain().highpass(100).lowpass(3000)
+    assert np.allclose(Pipeline(first, second)(stereo, sample_in=sr), both(stereo, sample_in=sr), atol=1e-5)
+    with pytest.raises(ValueError):
+        Pipeline(lambda block: block[0])(stereo, sample_in=sr)
+
+
+def test_file_buffer_read_error():
+    class Flaky(object):
+        def __init__(self, data):
+            self.f = io.BytesIO(data)
+
+        def read(self, size=-1):
+            if self.f.tell() > 200000:
+                raise ConnectionResetError('connection reset')
+            return self.f.read(size)
+
+    data = io.BytesIO()
+    sf.write(data, stereo.T, sr, format='WAV')
+    with pytest.raises(ConnectionResetError):
+        apply_audio_effects(Flaky(data.getvalue()))
+    with pytest.raises(ConnectionResetError):
+        asyncio.run(apply_audio_effects.apply_async(Flaky(data.getvalue())))